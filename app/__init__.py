@@ -2,22 +2,53 @@ from flask import Flask
 from flask_bootstrap import Bootstrap
 from flask_mail import Mail
 from flask_moment import Moment
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_pagedown import PageDown
 from flask_bcrypt import Bcrypt
 from flask_qrcode import QRcode
 from config import config
+from .cache import LRUCache
+from .replicas import RoutingSQLAlchemy
+from .pool import warm_up
+from .last_seen import LastSeenTracker
+from .registry import RoleRegistry
+from .render import MarkdownRenderer
+from .mailer import MailDispatcher
+from .search import SearchIndex
+from .response_cache import ResponseCache
+from .fragments import FragmentCache
+from .sqlstats import QueryStats
+from .profiler import Profiler
+from .metrics import Metrics
+from .purge import AccountPurger
+from .graph import FollowGraph
 
 
 bootstrap = Bootstrap()
 mail = Mail()
 moment = Moment()
-db = SQLAlchemy()
+# Reads from replicas where it is safe, see app/replicas.py
+db = RoutingSQLAlchemy()
 pagedown = PageDown()
 bcrypt = Bcrypt()
 login_manager = LoginManager()
 qrcode = QRcode()
+last_seen = LastSeenTracker()
+# Users loaded by Flask-Login, see models.load_user
+user_cache = LRUCache()
+role_registry = RoleRegistry()
+markdown_renderer = MarkdownRenderer()
+mail_dispatcher = MailDispatcher()
+search_index = SearchIndex()
+# Pages served to logged out visitors
+response_cache = ResponseCache()
+fragment_cache = FragmentCache()
+query_stats = QueryStats()
+profiler = Profiler()
+metrics = Metrics()
+account_purger = AccountPurger()
+# Who to follow, see app/graph.py
+follow_graph = FollowGraph()
 login_manager.login_view = 'auth.login'
 
 
@@ -36,6 +67,22 @@ def create_app(config_name):
     bcrypt.init_app(app)
     qrcode.init_app(app)
     login_manager.init_app(app)
+    last_seen.init_app(app)
+    role_registry.init_app(app)
+    markdown_renderer.init_app(app)
+    mail_dispatcher.init_app(app)
+    search_index.init_app(app)
+    response_cache.init_app(app)
+    fragment_cache.init_app(app)
+    query_stats.init_app(app)
+    profiler.init_app(app)
+    metrics.init_app(app)
+    account_purger.init_app(app)
+    follow_graph.init_app(app)
+    user_cache.configure(app.config['USER_CACHE_SIZE'],
+                         app.config['USER_CACHE_TTL'])
+    if app.config['SQLALCHEMY_POOL_WARMUP']:
+        warm_up(db, app)
 
     # http://flask.pocoo.org/docs/0.12/blueprints/#registering-blueprints
     from .main import main as main_blueprint
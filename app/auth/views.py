@@ -1,18 +1,20 @@
 from flask import render_template, redirect, request, url_for, flash
 from flask_login import login_user, logout_user, login_required, current_user
 from . import auth
-from .. import db
+from .. import db, user_cache
 from .form import LoginForm, SignupForm, ChangeEmailForm, ChangePasswordForm, \
     ResetPasswordForm, ResetPasswordRequestForm, \
     TwoFactorAuthenticatorForm, DeleteUserForm
 from ..email import sendmail
 from ..models import User
+from ..decorators import use_primary
 
 
 @auth.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.ping()
+        if request.endpoint != 'static':
+            current_user.ping()
         if not current_user.confirmed \
                 and request.endpoint \
                 and request.blueprint != 'auth' \
@@ -39,7 +41,7 @@ def login():
         # We can user username or email address as identification
         user = User.query.filter_by(username=form.user.data).first() \
                or User.query.filter_by(email=form.user.data).first()
-        if user is None:
+        if user is None or user.deleted_at is not None:
             flash('User not exists.')
             return redirect(url_for('auth.login'))
         if user.verify_password(form.password.data):
@@ -88,6 +90,7 @@ def logout():
 
 @auth.route('/confirm/<token>')
 @login_required
+@use_primary
 def confirm(token):
     if current_user.confirmed:
         # If the user is confirmed
@@ -128,6 +131,7 @@ def change_password():
             current_user.password = form.new_password.data
             db.session.add(current_user)
             db.session.commit()
+            user_cache.invalidate(current_user.id)
             flash('Password has been updated.')
             return redirect(url_for('main.index'))
 
@@ -190,6 +194,7 @@ def change_email_request():
 
 @auth.route('/change-email/<token>', methods=['GET', 'POST'])
 @login_required
+@use_primary
 def change_email(token):
     if current_user.verify_email_changing_token(token):
         flash('Your email address has been updated.')
@@ -210,6 +215,7 @@ def twofa():
                 current_user.twofa_enable = True
                 db.session.add(current_user)
                 db.session.commit()
+                user_cache.invalidate(current_user.id)
                 flash('You have successfully '
                       'enable two factor authentication.')
             else:
@@ -243,6 +249,7 @@ def delete_account():
     if form.validate_on_submit():
         if current_user.verify_password(form.password.data):
             current_user.delete_user()
+            logout_user()
             flash('Your data has been permanently deleted.')
         
         return redirect(url_for('main.index'))
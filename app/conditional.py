@@ -0,0 +1,46 @@
+from hashlib import sha1
+from flask import current_app, request, session
+from flask_login import current_user
+from werkzeug.http import is_resource_modified
+
+# Conditional GET: a view computes validators from the rows a page is built
+# from, and answers 304 Not Modified before loading anything else or
+# rendering the template when the client already has that version. There
+# is no Last-Modified: edits, comments and follows change a page without
+# changing any timestamp it shows.
+
+
+class Validators(object):
+    def __init__(self, *parts):
+        # The page also depends on who is looking at it and which page it is.
+        viewer = (current_user.get_id(),
+                  getattr(current_user, 'role_id', None))
+        digest = sha1(repr((viewer, request.full_path) + parts).
+                      encode('utf-8'))
+        self.etag = digest.hexdigest()
+
+    def not_modified(self):
+        """ A 304 response if the client copy is current, else None """
+        # Flashed messages are shown once, the cached copy does not have them.
+        if request.method != 'GET' or '_flashes' in session:
+            return None
+        if is_resource_modified(request.environ, etag=self.etag):
+            return None
+        return self.apply(current_app.response_class(status=304))
+
+    def apply(self, response):
+        """ Set the validators on response """
+        # Different content for the same version is fine, e.g. new timestamps.
+        response.set_etag(self.etag, weak=True)
+        # Always ask first, a browser may otherwise reuse the page as is.
+        response.cache_control.no_cache = True
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+        return response
+
+
+def post_versions(posts):
+    """ What a list of posts shows that can change, call load_authors
+    first """
+    return tuple((post.id, post.author.username, post.author.nickname,
+                  post.comment_count, bool(post.body_html)) for post in posts)
@@ -1,19 +1,9 @@
 from functools import wraps
-from threading import Thread
-from flask import abort
+from flask import abort, g
 from flask_login import current_user
 from .models import Permission
 
 
-def async_task(f):
-    """ Takes a function and runs it in a thread """
-    @wraps(f)
-    def _decorated(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
-    return _decorated
-
-
 def permission_required(permission):
     def decorator(f):
         @wraps(f)
@@ -25,5 +15,14 @@ def permission_required(permission):
     return decorator
 
 
+def use_primary(f):
+    """ For views that write on GET, so they read from the primary too """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        g.db_primary = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 def admin_required(f):
     return permission_required(Permission.ADMIN)(f)
@@ -1,12 +1,9 @@
 from flask_mail import Message
 from flask import current_app, render_template
-from . import mail
-from .decorators import async_task
+from . import mail_dispatcher
 
 
 def sendmail(to, subject='TEST', template=None, **kwargs):
-    # https://stackoverflow.com/questions/40326651/flask-mail-sending-email-asynchronously-based-on-flask-cookiecutter
-    app = current_app._get_current_object()
     msg = Message()
     # kwargs are arguments, like username
     msg.subject = current_app.config['MAIL_SUBJECT_PREFIX'] + subject
@@ -17,17 +14,5 @@ def sendmail(to, subject='TEST', template=None, **kwargs):
     else:
         msg.body = 'TEST'
     msg.add_recipient(to)
-    _send_async_email(app, msg)
-
-
-@async_task
-def _send_async_email(flask_app, msg):
-    """ Sends an send_email asynchronously
-    Args:
-        flask_app (flask.Flask): Current flask instance
-        msg (Message): Message to send
-    Returns:
-        None
-    """
-    with flask_app.app_context():
-        mail.send(msg)
+    # Sent in the background by a bounded worker pool, see app/mailer.py
+    return mail_dispatcher.submit(msg)
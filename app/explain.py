@@ -0,0 +1,91 @@
+from datetime import datetime
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+from . import db
+from .models import User, Post, Comment, Follow, Timeline, HotPost
+from .pagination import Keyset
+from .hot import score
+
+
+# https://github.com/sqlalchemy/sqlalchemy/wiki/Explain
+class Explain(Executable, ClauseElement):
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kwargs):
+    if compiler.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    return prefix + compiler.process(element.statement, **kwargs)
+
+
+def view_queries(per_page=50):
+    """ (endpoint, query, index it should use) for each main list view """
+    user_id = db.session.query(db.func.min(User.id)).scalar() or 1
+    post_id = db.session.query(db.func.min(Post.id)).scalar() or 1
+    # Deep pages are where OFFSET used to hurt, so explain one of those.
+    keyset = Keyset(per_page, before=(datetime.utcnow(), 0))
+
+    posts = Post.by_live_authors(Post.query)
+    timeline = posts.join(Timeline, Timeline.post_id == Post.id).\
+        filter(Timeline.user_id == user_id)
+    hot = Keyset(per_page, before=(score(0, datetime.utcnow()), 0))
+    return [
+        ('main.explore', keyset.query(posts, Post.time, Post.id),
+         'ix_posts_time'),
+        ('main.explore (hot)', hot.query(
+            posts.join(HotPost, HotPost.post_id == Post.id),
+            HotPost.score, HotPost.post_id),
+         'ix_hot_posts_score'),
+        ('main.index', keyset.query(timeline, Timeline.time,
+                                    Timeline.post_id),
+         'ix_timeline_user_id_time'),
+        ('main.index (popular)', keyset.query(
+            posts.filter(Post.author_id.in_([user_id])),
+            Post.time, Post.id),
+         'ix_posts_author_id_time'),
+        ('main.profile', keyset.query(
+            Post.query.filter_by(author_id=user_id), Post.time, Post.id),
+         'ix_posts_author_id_time'),
+        ('main.post', keyset.query(
+            Comment.query.filter_by(post_id=post_id),
+            Comment.time, Comment.id),
+         'ix_comments_post_id_time'),
+        ('main.following', keyset.query(
+            Follow.query.filter_by(follower_id=user_id),
+            Follow.time, Follow.followed_id),
+         'ix_follow_follower_id_time'),
+        ('main.follower', keyset.query(
+            Follow.query.filter_by(followed_id=user_id),
+            Follow.time, Follow.follower_id),
+         'ix_follow_followed_id_time'),
+    ]
+
+
+def explain(query):
+    """ Indexes used and whether the database sorts the rows itself """
+    rows = db.session.execute(Explain(query.statement)).fetchall()
+    if db.engine.dialect.name == 'sqlite':
+        # (id, parent, notused, detail), e.g.
+        # SEARCH TABLE posts USING INDEX ix_posts_author_id_time (...)
+        details = [row[-1] for row in rows]
+        sorts = any('TEMP B-TREE' in detail for detail in details)
+    else:
+        # MySQL: one row per table with key and Extra columns
+        details = ['%s: %s' % (row['table'], row['key']) for row in rows]
+        sorts = any('filesort' in (row['Extra'] or '') for row in rows)
+    return details, sorts
+
+
+def report(per_page=50):
+    """ Yield (endpoint, index, used, plan) for every main view query """
+    for endpoint, query, index in view_queries(per_page):
+        details, sorts = explain(query)
+        ok = any(index in detail for detail in details)
+        plan = '; '.join(details)
+        if sorts:
+            plan += '; sorts rows'
+        yield endpoint, index, ok, plan
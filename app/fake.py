@@ -1,8 +1,15 @@
-from random import randint
+from base64 import b64encode
+from bisect import bisect
+from itertools import accumulate
+from multiprocessing import Pool
+from os import urandom
+from random import Random, choice, paretovariate, random, seed
 from sqlalchemy.exc import IntegrityError
 from faker import Faker
-from . import db
-from .models import User, Post
+from flask_bcrypt import generate_password_hash
+from . import db, role_registry, timeline, search, hot
+from .models import User, Post, Follow, Comment
+from .render import render_markdown
 
 
 def users(count=50):
@@ -28,11 +35,165 @@ def users(count=50):
 
 def posts(count=100):
     fake = Faker()
-    user_count = User.query.count()
+    user_ids = [row[0] for row in db.session.query(User.id)]
     for i in range(count):
-        u = User.query.offset(randint(0, user_count - 1)).first()
         p = Post(body=fake.text(),
                  time=fake.past_date(),
-                 author=u)
+                 author_id=choice(user_ids))
         db.session.add(p)
     db.session.commit()
+
+
+# Bulk seeding for production sized datasets. Rows are built in worker
+# processes and written with Core executemany inserts, chunk by chunk,
+# bypassing the ORM and its per-object listeners. Derived data such as
+# timelines and the search index is rebuilt once at the end.
+_fake = None
+_user_ids = None
+_post_ids = None
+_render = None
+
+
+def _init_worker(user_ids, post_ids, render):
+    global _fake, _user_ids, _post_ids, _render
+    _fake = Faker()
+    _user_ids = user_ids
+    _post_ids = post_ids
+    # Markdown dominates the cost of a row. Without it body_html is left
+    # empty and the templates show the escaped body instead.
+    _render = render_markdown if render else lambda body: None
+
+
+def _make_users(job):
+    start, count, role_id, password_hash = job
+    _fake.seed(start)
+    rows = []
+    for i in range(start, start + count):
+        # Numbered names and addresses never collide with each other.
+        rows.append(dict(username='%s%d' % (_fake.user_name(), i),
+                         email='user%d@%s' % (i, _fake.free_email_domain()),
+                         password_hash=password_hash,
+                         confirmed=True,
+                         twofa=b64encode(urandom(16)).decode('utf-8'),
+                         twofa_enable=False,
+                         nickname=_fake.name(),
+                         location=_fake.city(),
+                         about=_fake.text(),
+                         register_time=_fake.date_time_between('-3y'),
+                         last_seen=_fake.date_time_between('-30d'),
+                         role_id=role_id))
+    return rows
+
+
+def _make_posts(job):
+    start, count = job
+    _fake.seed(start)
+    # Workers inherit the random state of the parent, seed per job instead.
+    rng = Random('posts%d' % start)
+    rows = []
+    for i in range(count):
+        body = _fake.text()
+        rows.append(dict(author_id=rng.choice(_user_ids), body=body,
+                         body_html=_render(body),
+                         time=_fake.date_time_between('-1y'),
+                         repost=False))
+    return rows
+
+
+def _make_comments(job):
+    start, count = job
+    _fake.seed(start)
+    rng = Random('comments%d' % start)
+    rows = []
+    for i in range(count):
+        body = _fake.sentence()
+        rows.append(dict(author_id=rng.choice(_user_ids),
+                         post_id=rng.choice(_post_ids), body=body,
+                         body_html=_render(body),
+                         time=_fake.date_time_between('-1y')))
+    return rows
+
+
+def _make_follows(followers, user_ids, cum_weights, average):
+    """ Follow edges of some users, picked by weight from user_ids """
+    total = cum_weights[-1]
+    rows = []
+    for follower in followers:
+        # Out-degree is heavy tailed too, a few users follow a lot.
+        count = min(int(paretovariate(2) * average / 2), len(user_ids) - 1)
+        followed = set()
+        for _ in range(count):
+            followed.add(user_ids[bisect(cum_weights, random() * total)])
+        followed.discard(follower)
+        rows.extend(dict(follower_id=follower, followed_id=f)
+                    for f in followed)
+    return rows
+
+
+def _generate(func, jobs, processes, *initargs):
+    """ Yield func(job) for every job, in worker processes if processes > 1 """
+    if processes == 1:
+        _init_worker(*initargs)
+        for job in jobs:
+            yield func(job)
+        return
+    pool = Pool(processes, initializer=_init_worker, initargs=initargs)
+    try:
+        for rows in pool.imap(func, jobs):
+            yield rows
+    finally:
+        pool.terminate()
+
+
+def _insert(table, batches):
+    for rows in batches:
+        if rows:
+            db.session.execute(table.insert(), rows)
+            db.session.commit()
+
+
+def _jobs(total, chunk_size, offset=0):
+    return [(offset + start, min(chunk_size, total - start))
+            for start in range(0, total, chunk_size)]
+
+
+def bulk(user_count=1000, post_count=100000, comment_count=100000,
+         follows=20, chunk_size=5000, processes=None, render=False):
+    """ Seed a large dataset in chunks, see the seed command """
+    seed()
+    # Hashing is slow on purpose, every seeded user gets the same one.
+    password_hash = generate_password_hash('password')
+    role_id = role_registry.id_for('User')
+    offset = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+
+    jobs = [(start, count, role_id, password_hash)
+            for start, count in _jobs(user_count, chunk_size, offset)]
+    _insert(User.__table__, _generate(_make_users, jobs, processes,
+                                      [], [], render))
+    user_ids = [row[0] for row in db.session.query(User.id)]
+
+    # Popularity follows a Pareto distribution and followers pick whom to
+    # follow in proportion to it, which gives a power-law follow graph.
+    cum_weights = list(accumulate(paretovariate(1.2) for _ in user_ids))
+    new_users = [i for i in user_ids if i >= offset]
+    step = max(chunk_size // max(follows, 1), 1)
+    _insert(Follow.__table__, (
+        _make_follows(new_users[i:i + step], user_ids, cum_weights, follows)
+        for i in range(0, len(new_users), step)))
+
+    _insert(Post.__table__, _generate(
+        _make_posts, _jobs(post_count, chunk_size), processes,
+        user_ids, [], render))
+    post_ids = [row[0] for row in db.session.query(Post.id)]
+
+    if post_ids:
+        _insert(Comment.__table__, _generate(
+            _make_comments, _jobs(comment_count, chunk_size), processes,
+            user_ids, post_ids, render))
+
+    User.reconcile_counters()
+    # Comments were inserted without the listeners that count them.
+    Post.backfill_comment_counts(chunk_size, recount=True)
+    timeline.rebuild()
+    search.rebuild(chunk_size)
+    hot.refresh(chunk_size)
@@ -0,0 +1,41 @@
+from hashlib import sha1
+from flask import render_template
+from jinja2 import Markup
+from .cache import LRUCache
+
+# Posts never change once written, so the part of a post every viewer sees
+# is rendered once and reused. Entries are kept by post id along with the
+# version they were rendered from: the body, the author's names, and
+# whether the Markdown body has been rendered yet (see MARKDOWN_ASYNC).
+# The body is part of it because ids of deleted posts can be reused.
+# Delete links, comment counts and other per viewer parts stay in the
+# calling template.
+
+
+class FragmentCache(object):
+    def __init__(self, app=None):
+        self._fragments = LRUCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self._fragments.configure(app.config['FRAGMENT_CACHE_SIZE'])
+        app.add_template_global(self.post, 'post_fragment')
+
+    def post(self, post):
+        """ The HTML of _post.html for post """
+        author = post.author
+        version = (sha1((post.body or '').encode('utf-8')).hexdigest(),
+                   author.username, author.nickname, bool(post.body_html))
+        cached = self._fragments.get(post.id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        html = Markup(render_template('_post.html', post=post))
+        self._fragments.set(post.id, (version, html))
+        return html
+
+    def invalidate(self, post_id):
+        self._fragments.invalidate(post_id)
+
+    def clear(self):
+        self._fragments.clear()
@@ -0,0 +1,224 @@
+import heapq
+import os
+import threading
+import time
+from array import array
+from collections import Counter, namedtuple
+from sqlalchemy import and_, event, select
+from sqlalchemy.orm import Session, object_session
+
+# The follow table held in memory for "who to follow" suggestions. Edges are
+# kept in compressed sparse row form, one array of offsets indexed by user
+# id and one of user ids, for both directions, about 8 bytes per follow.
+# Follows committed by this process are applied on top as they happen, the
+# whole graph is reloaded every FOLLOW_GRAPH_RELOAD seconds to pick up the
+# ones of other processes. Self follows are left out.
+
+Suggestion = namedtuple('Suggestion', ['user_id', 'mutual', 'follows_you'])
+
+
+class CSR(object):
+    """ Adjacency lists of the ids below size, from sorted (source, target)
+
+    The neighbours of id are targets[offsets[id]:offsets[id + 1]].
+    """
+
+    def __init__(self, size, offsets=None, targets=None):
+        self.size = size
+        self.offsets = array('l', [0]) * (size + 1) \
+            if offsets is None else offsets
+        self.targets = array('i') if targets is None else targets
+
+    def __getitem__(self, id):
+        if id >= self.size:
+            return self.targets[0:0]
+        return self.targets[self.offsets[id]:self.offsets[id + 1]]
+
+    def degree(self, id):
+        if id >= self.size:
+            return 0
+        return self.offsets[id + 1] - self.offsets[id]
+
+    def transpose(self):
+        """ The same edges the other way round """
+        offsets = array('l', [0]) * (self.size + 1)
+        for target in self.targets:
+            offsets[target + 1] += 1
+        for i in range(self.size):
+            offsets[i + 1] += offsets[i]
+        position = array('l', offsets)
+        targets = array('i', [0]) * len(self.targets)
+        for source in range(self.size):
+            for k in range(self.offsets[source], self.offsets[source + 1]):
+                target = self.targets[k]
+                targets[position[target]] = source
+                position[target] += 1
+        return CSR(self.size, offsets, targets)
+
+
+class FollowGraph(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._loaded = threading.Event()
+        self._loader_pid = None
+        self.following = self.followers = CSR(0)
+        # (follower id, followed id, followed or not) committed here since
+        # the snapshot was taken, and the same changes by user id
+        self._log = []
+        self._overlay = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.reload_interval = app.config['FOLLOW_GRAPH_RELOAD']
+        self.max_degree = app.config['FOLLOW_GRAPH_MAX_DEGREE']
+
+    def load(self, chunk_size=10000):
+        """ Read the follow table into a new snapshot and swap it in """
+        from . import db, metrics
+        from .models import User, Follow
+        follow = Follow.__table__
+        start = time.time()
+        with self._lock:
+            # Changes committed from now on may be missing from the snapshot.
+            mark = len(self._log)
+        size = (db.session.query(db.func.max(User.id)).scalar() or 0) + 1
+        following = CSR(size)
+        for low in range(0, size, chunk_size):
+            rows = db.session.execute(
+                select([follow.c.follower_id, follow.c.followed_id]).where(
+                    and_(follow.c.follower_id >= low,
+                         follow.c.follower_id < min(low + chunk_size, size),
+                         follow.c.follower_id != follow.c.followed_id)).
+                order_by(follow.c.follower_id, follow.c.followed_id))
+            for follower_id, followed_id in rows:
+                # Users who signed up after size was read, until next time
+                if follower_id < size and followed_id < size:
+                    following.targets.append(followed_id)
+                    following.offsets[follower_id + 1] += 1
+        db.session.commit()
+        for i in range(size):
+            following.offsets[i + 1] += following.offsets[i]
+        followers = following.transpose()
+
+        with self._lock:
+            self.following, self.followers = following, followers
+            self._log = self._log[mark:]
+            self._overlay = {}
+            for change in self._log:
+                self._add_to_overlay(*change)
+        self._loaded.set()
+        metrics.observe('microblog_follow_graph_load_seconds',
+                        time.time() - start)
+
+    def apply(self, changes):
+        """ Add committed (follower id, followed id, followed) changes """
+        with self._lock:
+            self._log.extend(changes)
+            for change in changes:
+                self._add_to_overlay(*change)
+
+    def _add_to_overlay(self, follower_id, followed_id, followed):
+        for key in ('following', follower_id, followed_id), \
+                ('followers', followed_id, follower_id):
+            added, removed = self._overlay.setdefault(
+                key[:2], (set(), set()))
+            if followed:
+                removed.discard(key[2])
+                added.add(key[2])
+            else:
+                added.discard(key[2])
+                removed.add(key[2])
+
+    def _changes(self, kind, user_id):
+        # Copied, apply() changes the sets in place.
+        added, removed = self._overlay.get((kind, user_id), ((), ()))
+        return set(added), set(removed)
+
+    def suggest(self, user_id, limit):
+        """ Users user_id might follow, best first, or None while the
+        graph is still loading
+
+        Candidates are followed by people user_id follows, or follow
+        user_id already. Those who follow user_id come first, then the
+        ones followed by the most of user_id's follows, then by followers.
+        Follows of accounts following more than FOLLOW_GRAPH_MAX_DEGREE
+        users are not counted, they say little about either user.
+        """
+        self._start_loader()
+        if not self._loaded.is_set():
+            return None
+        # Snapshots never change once swapped in, the overlay does, so only
+        # the changes this needs are copied under the lock.
+        with self._lock:
+            following_csr, followers_csr = self.following, self.followers
+            following = _neighbours(following_csr, user_id,
+                                    self._changes('following', user_id))
+            followers = _neighbours(followers_csr, user_id,
+                                    self._changes('followers', user_id))
+            changes = {id: self._changes('following', id)
+                       for id in following}
+        mutual = Counter()
+        for id in following:
+            theirs = _neighbours(following_csr, id, changes[id])
+            if len(theirs) <= self.max_degree:
+                mutual.update(theirs)
+        candidates = (set(mutual) | followers) - following - {user_id}
+        degree = followers_csr.degree
+        best = heapq.nlargest(limit, candidates, key=lambda id: (
+            id in followers, mutual[id], degree(id), -id))
+        return [Suggestion(id, mutual[id], id in followers) for id in best]
+
+    def _start_loader(self):
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._loader_pid == os.getpid():
+                return
+            self._loader_pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='follow-graph')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                with self.app.app_context():
+                    self.load()
+            except Exception:
+                self.app.logger.exception('Failed to load the follow graph.')
+                # Suggest from whatever is there rather than wait forever.
+                self._loaded.set()
+            time.sleep(self.reload_interval)
+
+    def track(self, model):
+        """ Queue follows and unfollows of model until they commit """
+        def changed(followed):
+            def listener(mapper, connection, target):
+                if target.follower_id != target.followed_id:
+                    object_session(target).info.setdefault(
+                        'follow_graph', []).append(
+                        (target.follower_id, target.followed_id, followed))
+            return listener
+
+        event.listen(model, 'after_insert', changed(True))
+        event.listen(model, 'after_delete', changed(False))
+
+
+def _neighbours(csr, user_id, changes):
+    added, removed = changes
+    return (set(csr[user_id]) - removed) | added
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    from . import follow_graph
+    changes = session.info.pop('follow_graph', None)
+    if changes:
+        follow_graph.apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_changes(session):
+    session.info.pop('follow_graph', None)
@@ -0,0 +1,158 @@
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select, and_, case
+from . import db
+from .models import Post, Comment, HotPost
+from .pagination import Keyset
+from .search import encode_cursor, decode_cursor
+
+# Hot ranking of recent posts, as on Reddit: the score is log10 of the
+# engagement plus the age of the post in units of HOT_DECAY seconds, so ten
+# times the comments equal a post HOT_DECAY seconds newer. The score never
+# decays by itself, newer posts simply start higher, so it only changes
+# when a comment is added or removed, which the listeners below do in the
+# same transaction. Posts only have a row here while they are younger
+# than HOT_WINDOW seconds. The hot page is one range scan of
+# ix_hot_posts_score. Reposts do not point at the post they repeat, so
+# engagement is the number of comments.
+hot = HotPost.__table__
+posts = Post.__table__
+
+EPOCH = datetime(2018, 1, 1)
+
+
+def score(comments, posted):
+    decay = current_app.config['HOT_DECAY']
+    return math.log10(max(comments, 1)) + \
+        (posted - EPOCH).total_seconds() / decay
+
+
+def _in_window(posted):
+    return posted >= datetime.utcnow() - timedelta(
+        seconds=current_app.config['HOT_WINDOW'])
+
+
+@db.event.listens_for(Post, 'after_insert')
+def post_added(mapper, connection, target):
+    if target.time is not None and _in_window(target.time):
+        connection.execute(hot.insert().values(
+            post_id=target.id, score=score(0, target.time), comments=0,
+            time=target.time))
+
+
+@db.event.listens_for(Post, 'before_delete')
+def post_removed(mapper, connection, target):
+    connection.execute(hot.delete().where(hot.c.post_id == target.id))
+
+
+def _comment_counted(connection, post_id, delta):
+    # Counted in the UPDATE, which locks the row until the transaction ends,
+    # so concurrent comments cannot overwrite each other's count.
+    comments = hot.c.comments + delta
+    result = connection.execute(hot.update().where(
+        hot.c.post_id == post_id).values(
+        comments=case([(comments < 0, 0)], else_=comments)))
+    # Not in the window, or the post is gone
+    if not result.rowcount:
+        return
+    row = connection.execute(select([hot.c.comments, hot.c.time]).where(
+        hot.c.post_id == post_id)).first()
+    connection.execute(hot.update().where(hot.c.post_id == post_id).values(
+        score=score(row.comments, row.time)))
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def comment_added(mapper, connection, target):
+    _comment_counted(connection, target.post_id, 1)
+
+
+@db.event.listens_for(Comment, 'after_delete')
+def comment_removed(mapper, connection, target):
+    _comment_counted(connection, target.post_id, -1)
+
+
+def hot_page(per_page):
+    """ One keyset page of the hot posts, keyed on (score, post id) """
+    _refresher.start(current_app._get_current_object())
+    keyset = Keyset.from_request(per_page, encode=encode_cursor,
+                                 decode=decode_cursor)
+    rows = keyset.query(
+        Post.by_live_authors(db.session.query(Post, HotPost.score).join(
+            HotPost, HotPost.post_id == Post.id)),
+        HotPost.score, HotPost.post_id).all()
+    page = keyset.page(rows, key=lambda row: (row.score, row.Post.id))
+    page.items = [row.Post for row in page.items]
+    return page
+
+
+def refresh(chunk_size=1000):
+    """ Drop posts older than HOT_WINDOW and recount the others
+
+    Comments are counted from the comments table, not posts.comment_count,
+    which corrects changes made without the listeners, such as bulk
+    seeding and account purges.
+    """
+    cutoff = datetime.utcnow() - timedelta(
+        seconds=current_app.config['HOT_WINDOW'])
+    db.session.execute(hot.delete().where(hot.c.time < cutoff))
+    db.session.commit()
+    last = 0
+    while True:
+        rows = db.session.execute(
+            select([posts.c.id, posts.c.time]).
+            where(and_(posts.c.time >= cutoff, posts.c.id > last)).
+            order_by(posts.c.id).limit(chunk_size)).fetchall()
+        if not rows:
+            break
+        last = rows[-1].id
+        ids = [row.id for row in rows]
+        counts = Post.count_comments(ids)
+        db.session.execute(hot.delete().where(hot.c.post_id.in_(ids)))
+        db.session.execute(hot.insert(), [dict(
+            post_id=row.id, time=row.time, comments=counts.get(row.id, 0),
+            score=score(counts.get(row.id, 0), row.time)) for row in rows])
+        db.session.commit()
+
+
+class _Refresher(object):
+    """ Runs refresh every HOT_REFRESH_INTERVAL seconds, 0 disables it
+
+    Started by the first hot page a process serves. Every process runs its
+    own, which is harmless. With it disabled, run the refresh_hot command
+    from cron instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._worker_pid = None
+
+    def start(self, app):
+        interval = app.config['HOT_REFRESH_INTERVAL']
+        if not interval:
+            return
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+        thread = threading.Thread(target=self._run, args=(app, interval),
+                                  name='hot-refresh')
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def _run(app, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                with app.app_context():
+                    refresh()
+            except Exception:
+                app.logger.exception('Failed to refresh hot posts.')
+
+
+_refresher = _Refresher()
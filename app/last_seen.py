@@ -0,0 +1,83 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam
+
+
+class LastSeenTracker(object):
+    """ Buffers User.last_seen in memory and writes it in batches
+
+    A user is recorded at most once per LAST_SEEN_INTERVAL seconds, and the
+    buffer is flushed with a single executemany UPDATE every
+    LAST_SEEN_FLUSH_INTERVAL seconds by a background thread.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        # user id -> time waiting to be written
+        self._pending = {}
+        # user id -> time last recorded, used to throttle
+        self._seen = {}
+        self._worker_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.interval = timedelta(seconds=app.config['LAST_SEEN_INTERVAL'])
+        self.flush_interval = app.config['LAST_SEEN_FLUSH_INTERVAL']
+        atexit.register(self.flush)
+
+    def touch(self, user_id, now=None):
+        now = now or datetime.utcnow()
+        with self._lock:
+            last = self._seen.get(user_id)
+            if last is not None and now - last < self.interval:
+                return
+            self._seen[user_id] = now
+            self._pending[user_id] = now
+        self._start_worker()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            # Users not seen for a whole interval would be recorded anyway.
+            cutoff = datetime.utcnow() - self.interval
+            self._seen = {k: v for k, v in self._seen.items() if v > cutoff}
+        if not pending:
+            return
+
+        from . import db
+        from .models import User
+        users = User.__table__
+        update = users.update().where(users.c.id == bindparam('_id')).\
+            values(last_seen=bindparam('_last_seen'))
+        try:
+            with self.app.app_context():
+                db.engine.execute(update, [
+                    {'_id': k, '_last_seen': v} for k, v in pending.items()])
+        except Exception:
+            self.app.logger.exception('Failed to write last seen times.')
+            with self._lock:
+                for k, v in pending.items():
+                    self._pending.setdefault(k, v)
+
+    def _start_worker(self):
+        # One thread per process; checking the pid restarts it after a fork.
+        if self._worker_pid == os.getpid():
+            return
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='last-seen')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
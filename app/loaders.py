@@ -0,0 +1,82 @@
+from collections import namedtuple
+from flask import g
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.util import identity_key
+from . import db
+from .models import User, Post, Follow
+
+# post.author and comment.author are lazy, so rendering a page of them
+# would issue one SELECT per row. Resolve them for the whole page at once.
+
+
+def load_authors(items):
+    """ Populate item.author for every post or comment with one query """
+    pending = [item for item in items if 'author' not in item.__dict__]
+    authors = {}
+    missing = set()
+    for item in pending:
+        # Users already in the session, such as current_user, are reused.
+        author = db.session.identity_map.get(
+            identity_key(User, item.author_id))
+        if author is not None:
+            authors[item.author_id] = author
+        elif item.author_id is not None:
+            missing.add(item.author_id)
+
+    if missing:
+        for user in User.query.filter(User.id.in_(missing)):
+            authors[user.id] = user
+
+    for item in pending:
+        # Set the relationship as if it was loaded, without dirtying the item.
+        set_committed_value(item, 'author', authors.get(item.author_id))
+    return items
+
+
+def load_comment_counts(posts):
+    """ Fill in comment_count of posts that were never backfilled """
+    missing = [post for post in posts if post.comment_count is None]
+    if missing:
+        counts = Post.count_comments([post.id for post in missing])
+        for post in missing:
+            set_committed_value(post, 'comment_count',
+                                counts.get(post.id, 0))
+    return posts
+
+
+Relationship = namedtuple('Relationship', ['following', 'followed_by'])
+
+
+def load_relationships(viewer, user_ids):
+    """ {user id: Relationship} of viewer to each user, with one query
+
+    Answers are kept in g for the rest of the request, so the follow
+    buttons, "Follows you" labels and User.is_following share them.
+    """
+    if not viewer.is_authenticated:
+        return {id: Relationship(False, False) for id in user_ids}
+    cache = g.setdefault('relationships', {})
+    missing = {id for id in user_ids if (viewer.id, id) not in cache}
+    if missing:
+        following = set()
+        followed_by = set()
+        rows = db.session.query(Follow.follower_id, Follow.followed_id).\
+            filter(db.or_(
+                db.and_(Follow.follower_id == viewer.id,
+                        Follow.followed_id.in_(missing)),
+                db.and_(Follow.followed_id == viewer.id,
+                        Follow.follower_id.in_(missing))))
+        for follower_id, followed_id in rows:
+            if follower_id == viewer.id:
+                following.add(followed_id)
+            if followed_id == viewer.id:
+                followed_by.add(follower_id)
+        for id in missing:
+            cache[viewer.id, id] = Relationship(id in following,
+                                                id in followed_by)
+    return {id: cache[viewer.id, id] for id in user_ids}
+
+
+def forget_relationships():
+    """ Drop the answers of this request, after a follow or unfollow """
+    g.pop('relationships', None)
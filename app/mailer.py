@@ -0,0 +1,163 @@
+import heapq
+import itertools
+import os
+import smtplib
+import threading
+import time
+from queue import Queue, Full, Empty
+
+
+class MailDispatcher(object):
+    """ Sends mail from a bounded queue with a fixed pool of workers
+
+    Each worker takes up to MAIL_BATCH_SIZE queued messages and sends them
+    over a single SMTP connection. Failed messages are retried with
+    exponential backoff up to MAIL_MAX_RETRIES times. They wait in a heap
+    by due time, at most MAIL_QUEUE_SIZE of them, which the workers take
+    from before the queue. When the queue is full, submit() blocks for
+    MAIL_QUEUE_TIMEOUT seconds and then gives up.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._queue = None
+        # (due time, sequence, msg, attempts) of messages to retry
+        self._delayed = []
+        self._sequence = itertools.count()
+        self._workers_pid = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rejected = 0
+        self.send_time = 0.0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.workers = app.config['MAIL_WORKERS']
+        self.batch_size = app.config['MAIL_BATCH_SIZE']
+        self.max_retries = app.config['MAIL_MAX_RETRIES']
+        self.retry_delay = app.config['MAIL_RETRY_DELAY']
+        self.queue_timeout = app.config['MAIL_QUEUE_TIMEOUT']
+        self._queue = Queue(app.config['MAIL_QUEUE_SIZE'])
+
+    def submit(self, msg):
+        """ Queue msg for sending, returns False if the queue stayed full """
+        self._start_workers()
+        try:
+            self._queue.put((msg, 0), timeout=self.queue_timeout)
+        except Full:
+            with self._lock:
+                self.rejected += 1
+            self.app.logger.error('Mail queue is full, dropped a message.')
+            return False
+        return True
+
+    def stats(self):
+        with self._lock:
+            return dict(depth=self._queue.qsize(),
+                        delayed=len(self._delayed), sent=self.sent,
+                        failed=self.failed, retried=self.retried,
+                        rejected=self.rejected, send_time=self.send_time)
+
+    def _start_workers(self):
+        # Threads do not survive a fork, so start them in each process.
+        with self._lock:
+            if self._workers_pid == os.getpid():
+                return
+            self._workers_pid = os.getpid()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='mail-%d' % i)
+            thread.daemon = True
+            thread.start()
+
+    def _run(self):
+        while True:
+            batch, wait = self._due()
+            queued = 0
+            if not batch:
+                try:
+                    batch.append(self._queue.get(timeout=wait))
+                except Empty:
+                    continue
+                queued += 1
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+                queued += 1
+            try:
+                self._send_batch(batch)
+            except Exception:
+                self.app.logger.exception('Mail worker failed.')
+            finally:
+                for _ in range(queued):
+                    self._queue.task_done()
+
+    def _due(self):
+        """ Retries that are due, up to a batch, and how long until the
+        next one is, None if there is none """
+        now = time.time()
+        batch = []
+        with self._lock:
+            while self._delayed and len(batch) < self.batch_size and \
+                    self._delayed[0][0] <= now:
+                due, sequence, msg, attempts = heapq.heappop(self._delayed)
+                batch.append((msg, attempts))
+            wait = self._delayed[0][0] - now if self._delayed else None
+        return batch, wait
+
+    def _send_batch(self, batch):
+        from . import mail, metrics
+        pending = list(batch)
+        with self.app.app_context():
+            try:
+                with mail.connect() as connection:
+                    while pending:
+                        msg, attempts = pending[0]
+                        start = time.time()
+                        try:
+                            connection.send(msg)
+                        except smtplib.SMTPRecipientsRefused:
+                            # Retrying will not help a bad address.
+                            self._give_up(msg)
+                        except (smtplib.SMTPException, OSError):
+                            self._retry(msg, attempts)
+                        else:
+                            elapsed = time.time() - start
+                            with self._lock:
+                                self.sent += 1
+                                self.send_time += elapsed
+                            metrics.observe('microblog_mail_send_seconds',
+                                            elapsed)
+                        pending.pop(0)
+            except (smtplib.SMTPException, OSError):
+                # Could not connect, or the connection dropped on QUIT.
+                for msg, attempts in pending:
+                    self._retry(msg, attempts)
+
+    def _retry(self, msg, attempts):
+        if attempts >= self.max_retries:
+            self._give_up(msg)
+            return
+        due = time.time() + self.retry_delay * 2 ** attempts
+        with self._lock:
+            full = len(self._delayed) >= self._queue.maxsize
+            if not full:
+                self.retried += 1
+                heapq.heappush(self._delayed, (
+                    due, next(self._sequence), msg, attempts + 1))
+        if full:
+            self._give_up(msg)
+
+    def _give_up(self, msg):
+        from . import metrics
+        with self._lock:
+            self.failed += 1
+        metrics.inc('microblog_mail_failed_total')
+        self.app.logger.error('Failed to send mail to %s.',
+                              ', '.join(msg.recipients))
@@ -4,7 +4,8 @@ from wtforms import StringField, TextAreaField, BooleanField, \
 from wtforms.validators import DataRequired, Length, Email
 from wtforms import ValidationError
 from flask_pagedown.fields import PageDownField
-from ..models import Role, User
+from .. import role_registry
+from ..models import User
 
 
 class EditProfileForm(FlaskForm):
@@ -31,8 +32,7 @@ class AdminEditProfileForm(FlaskForm):
     def __init__(self, user, *args, **kwargs):
         super(AdminEditProfileForm, self).__init__(*args, **kwargs)
         # Set role choices
-        self.role.choices = [(role.id, role.name)
-                             for role in Role.query.order_by(Role.name).all()]
+        self.role.choices = role_registry.choices()
         self.user = user
 
     def validate_email(self, field):
@@ -1,25 +1,72 @@
-from flask import redirect, render_template, url_for, flash, \
-    request, current_app
+from flask import redirect, render_template, url_for, flash, current_app, \
+    request, make_response, abort
 from flask_login import login_required, current_user
 
 from . import main
 from .form import EditProfileForm, AdminEditProfileForm, PostForm, CommentForm
-from .. import db
-from ..models import Permission, Role, User, Post, Comment, Follow
-from ..decorators import admin_required
+from .. import db, user_cache, search_index, response_cache, query_stats, \
+    metrics, follow_graph
+from ..models import Permission, User, Post, Comment, Follow
+from ..decorators import admin_required, use_primary
+from ..loaders import load_authors, load_comment_counts, load_relationships
+from ..pagination import Keyset, paginate
+from ..timeline import home_page
+from ..hot import hot_page
+from ..search import encode_cursor, decode_cursor
+from ..conditional import Validators, post_versions
 
 
 @main.route('/explore')
+@response_cache.cached('posts')
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.time.desc()).\
-        paginate(page, current_app.config['POSTS_PER_PAGE'], True)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template('index.html', posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+    per_page = current_app.config['POSTS_PER_PAGE']
+    mode = 'hot' if request.args.get('mode') == 'hot' else 'latest'
+    if mode == 'hot':
+        # Comments on posts not shown can reorder the page too, cached
+        # copies catch up within RESPONSE_CACHE_TTL.
+        posts = hot_page(per_page)
+    else:
+        posts = paginate(Post.by_live_authors(Post.query), Post.time,
+                         Post.id, per_page)
+    response_cache.tag(*('post:%d' % post.id for post in posts.items))
+    # The counts and names are part of the version, so they are loaded
+    # first.
+    load_comment_counts(posts.items)
+    load_authors(posts.items)
+    validators = Validators(post_versions(posts.items))
+    not_modified = validators.not_modified()
+    if not_modified:
+        return not_modified
+
+    mode_arg = 'hot' if mode == 'hot' else None
+    next_url = url_for('main.explore', mode=mode_arg,
+                       before=posts.next_cursor) if posts.has_next else None
+    prev_url = url_for('main.explore', mode=mode_arg,
+                       after=posts.prev_cursor) if posts.has_prev else None
+    return validators.apply(make_response(render_template(
+        'index.html', posts=posts.items, mode=mode,
+        next_url=next_url, prev_url=prev_url)))
+
+
+@main.route('/search')
+def search():
+    q = request.args.get('q', '').strip()
+    per_page = current_app.config['SEARCH_PER_PAGE']
+    # Ranked by relevance, so pages are keyed on (score, id) instead of time.
+    results = search_index.search(
+        q, per_page + 1, request.args.get('after', type=decode_cursor))
+    next_url = url_for('main.search', q=q,
+                       after=encode_cursor(results[per_page - 1])) \
+        if len(results) > per_page else None
+    ids = [id for score, id in results[:per_page]]
+
+    posts = {post.id: post for post in Post.by_live_authors(
+        Post.query).filter(Post.id.in_(ids))} if ids else {}
+    # Deleted posts can linger in the index until it catches up.
+    posts = [posts[id] for id in ids if id in posts]
+    load_comment_counts(posts)
+    return render_template('search.html', q=q, posts=load_authors(posts),
+                           next_url=next_url)
 
 
 @main.route('/', methods=['GET', 'POST'])
@@ -32,34 +79,47 @@ def index():
         db.session.add(post)
         db.session.commit()
         return redirect(url_for('main.index'))
-    # Join will combine two table, then filter by follower.
-    own = Post.query.filter_by(author=current_user._get_current_object())
-    page = request.args.get('page', 1, type=int)
-    others = Post.query.join(Follow, Follow.followed_id == Post.author_id).\
-        filter(Follow.follower_id == current_user.id)
-    posts = others.union(own).order_by(Post.time.desc()).\
-        paginate(page, current_app.config['POSTS_PER_PAGE'], True)
-    next_url = url_for('main.index', page=posts.next_num) \
+    # Posts are fanned out into the timeline table when they are written.
+    posts = home_page(current_user, Keyset.from_request(
+        current_app.config['POSTS_PER_PAGE']))
+    next_url = url_for('main.index', before=posts.next_cursor) \
         if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
+    prev_url = url_for('main.index', after=posts.prev_cursor) \
         if posts.has_prev else None
-    return render_template('index.html', posts=posts.items, form=form,
-                           next_url=next_url, prev_url=prev_url)
+    load_comment_counts(posts.items)
+    return render_template('index.html', posts=load_authors(posts.items),
+                           form=form, next_url=next_url, prev_url=prev_url)
     
 
 @main.route('/profile/<username>')
+@response_cache.cached()
 def profile(username):
-    page = request.args.get('page', 1, type=int)
-    user = User.query.filter_by(username=username).first_or_404()
-    posts = Post.query.filter_by(author=user).order_by(Post.time.desc()).\
-        paginate(page, current_app.config['POSTS_PER_PAGE'], True)
+    user = User.query.filter_by(username=username,
+                                deleted_at=None).first_or_404()
+    response_cache.tag('user:%d' % user.id)
+    posts = paginate(Post.query.filter_by(author=user), Post.time, Post.id,
+                     current_app.config['POSTS_PER_PAGE'])
     next_url = url_for('main.profile', username=username,
-                       page=posts.next_num) if posts.has_next else None
+                       before=posts.next_cursor) if posts.has_next else None
     prev_url = url_for('main.profile', username=username,
-                       page=posts.prev_num) if posts.has_prev else None
-
-    return render_template('profile.html', user=user, posts=posts.items,
-                           next_url=next_url, prev_url=prev_url)
+                       after=posts.prev_cursor) if posts.has_prev else None
+    # Comment counts of the posts shown
+    response_cache.tag(*('post:%d' % post.id for post in posts.items))
+    load_comment_counts(posts.items)
+    load_authors(posts.items)
+    # The counters change with follows, so does the follow button.
+    validators = Validators(
+        (user.username, user.nickname, user.location, user.about,
+         user.last_seen, user.post_count, user.follower_count,
+         user.following_count), post_versions(posts.items))
+    not_modified = validators.not_modified()
+    if not_modified:
+        return not_modified
+
+    return validators.apply(make_response(render_template(
+        'profile.html', user=user, posts=posts.items,
+        relationship=load_relationships(current_user, [user.id])[user.id],
+        next_url=next_url, prev_url=prev_url)))
 
 
 @main.route('/edit-profile', methods=['GET', 'POST'])
@@ -76,6 +136,7 @@ def edit_profile():
         current_user.about = form.about.data
         db.session.add(current_user)
         db.session.commit()
+        user_cache.invalidate(current_user.id)
         return redirect(url_for('main.index'))
 
     form.username.data = current_user.username
@@ -99,12 +160,13 @@ def admin_edit_profile(id):
         user.email = form.email.data
         user.username = form.username.data
         user.confirmed = form.confirmed.data
-        user.role = Role.query.get(form.role.data)
+        user.role_id = form.role.data
         user.nickname = form.nickname.data
         user.location = form.location.data
         user.about = form.about.data
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash('The profile has been updated.')
         return redirect(url_for('main.profile', username=user.username))
 
@@ -120,16 +182,28 @@ def admin_edit_profile(id):
 
 @main.route('/post/<int:id>', methods=['GET', 'POST'])
 def post(id):
-    post = Post.query.get_or_404(id)
-    page = request.args.get('page', 1, type=int)
-    comments = Comment.query.filter_by(post=post).order_by(
-        Comment.time.desc()).paginate(
-        page, current_app.config['COMMENTS_PER_PAGE'], True)
-    next_url = url_for('main.post', id=id, page=comments.next_num) \
+    post = Post.by_live_authors(Post.query).filter(
+        Post.id == id).first_or_404()
+    comments = paginate(Comment.query.filter_by(post=post),
+                        Comment.time, Comment.id,
+                        current_app.config['COMMENTS_PER_PAGE'])
+    next_url = url_for('main.post', id=id, before=comments.next_cursor) \
         if comments.has_next else None
-    prev_url = url_for('main.post', id=id, page=comments.prev_num) \
+    prev_url = url_for('main.post', id=id, after=comments.prev_cursor) \
         if comments.has_prev else None
 
+    # Pages with the comment form carry a CSRF token that expires.
+    validators = None
+    if not current_user.can(Permission.COMMENT):
+        load_authors([post] + comments.items)
+        validators = Validators(
+            post_versions([post]),
+            tuple((c.id, c.author.username, c.author.nickname)
+                  for c in comments.items))
+        not_modified = validators.not_modified()
+        if not_modified:
+            return not_modified
+
     form = CommentForm()
     if form.validate_on_submit():
         comment = Comment(body=form.body.data, post=post,
@@ -139,13 +213,16 @@ def post(id):
         flash('Your comment has been commited.')
         return redirect(url_for('main.post', id=post.id))
 
-    return render_template('post.html',
-                           post=post, form=form, comments=comments.items,
-                           next_url=next_url, prev_url=prev_url)
+    load_authors([post] + comments.items)
+    response = make_response(render_template(
+        'post.html', post=post, form=form, comments=comments.items,
+        next_url=next_url, prev_url=prev_url))
+    return validators.apply(response) if validators else response
 
 
 @main.route('/post/<int:id>/delete')
 @login_required
+@use_primary
 def post_delete(id):
     if current_user.can(Permission.MODERATE) or \
             current_user._get_current_object() is \
@@ -161,6 +238,7 @@ def post_delete(id):
 
 @main.route('/comment/<int:id>/delete')
 @login_required
+@use_primary
 def comment_delete(id):
     if current_user.can(Permission.MODERATE) \
             or current_user._get_current_object() is \
@@ -178,8 +256,10 @@ def comment_delete(id):
 
 @main.route('/follow/<username>')
 @login_required
+@use_primary
 def follow(username):
-    user = User.query.filter_by(username=username).first()
+    user = User.query.filter_by(username=username,
+                                deleted_at=None).first()
     if current_user.can(Permission.FOLLOW) and user is not None \
             and not current_user.is_following(user):
         current_user.follow(user)
@@ -190,8 +270,10 @@ def follow(username):
 
 @main.route('/unfollow/<username>')
 @login_required
+@use_primary
 def unfollow(username):
-    user = User.query.filter_by(username=username).first()
+    user = User.query.filter_by(username=username,
+                                deleted_at=None).first()
     if user is not None and current_user.is_following(user):
         current_user.unfollow(user)
         flash('Unfollowed')
@@ -201,37 +283,80 @@ def unfollow(username):
 
 @main.route('/following/<username>')
 def following(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    user = User.query.filter_by(username=username,
+                                deleted_at=None).first_or_404()
 
-    follow = Follow.query.filter_by(follower=user).filter(
-        Follow.followed_id != user.id).order_by(Follow.time.desc()).\
-        paginate(page, current_app.config['FOLLOW_PER_PAGE'], True)
+    follow = paginate(Follow.query.filter_by(follower=user).filter(
+        Follow.followed_id != user.id), Follow.time, Follow.followed_id,
+        current_app.config['FOLLOW_PER_PAGE'])
 
     next_url = url_for('main.following', username=username,
-                       page=follow.next_num) if follow.has_next else None
+                       before=follow.next_cursor) if follow.has_next else None
     prev_url = url_for('main.following', username=username,
-                       page=follow.prev_num) if follow.has_prev else None
+                       after=follow.prev_cursor) if follow.has_prev else None
 
+    # Follow buttons and "Follows you" labels of the whole page at once
+    relationships = load_relationships(
+        current_user, [fol.followed_id for fol in follow.items])
     return render_template('follow.html',
                            user=user, follow=follow.items, title='Following',
+                           relationships=relationships,
                            next_url=next_url, prev_url=prev_url)
 
 
 @main.route('/follower/<username>')
 def follower(username):
-    user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
+    user = User.query.filter_by(username=username,
+                                deleted_at=None).first_or_404()
 
-    follow = Follow.query.filter_by(followed=user).filter(
-        Follow.follower_id != user.id).order_by(Follow.time.desc()).\
-        paginate(page, current_app.config['FOLLOW_PER_PAGE'], True)
+    follow = paginate(Follow.query.filter_by(followed=user).filter(
+        Follow.follower_id != user.id), Follow.time, Follow.follower_id,
+        current_app.config['FOLLOW_PER_PAGE'])
 
-    next_url = url_for('main.following', username=username,
-                       page=follow.next_num) if follow.has_next else None
-    prev_url = url_for('main.following', username=username,
-                       page=follow.prev_num) if follow.has_prev else None
+    next_url = url_for('main.follower', username=username,
+                       before=follow.next_cursor) if follow.has_next else None
+    prev_url = url_for('main.follower', username=username,
+                       after=follow.prev_cursor) if follow.has_prev else None
 
+    relationships = load_relationships(
+        current_user, [fol.follower_id for fol in follow.items])
     return render_template('follow.html',
                            user=user, follow=follow.items, title='Follower',
+                           relationships=relationships,
                            next_url=next_url, prev_url=prev_url)
+
+
+@main.route('/suggestions')
+@login_required
+def suggestions():
+    # Ranked from the follow graph in memory, see app/graph.py
+    ranked = follow_graph.suggest(
+        current_user.id, current_app.config['SUGGESTIONS_PER_PAGE'])
+    if ranked is None:
+        return render_template('suggestions.html', loading=True,
+                               suggestions=[])
+    users = {user.id: user for user in User.query.filter(
+        User.id.in_([s.user_id for s in ranked]),
+        User.deleted_at == None)} if ranked else {}
+    return render_template(
+        'suggestions.html', suggestions=[
+            (users[s.user_id], s) for s in ranked if s.user_id in users])
+
+
+@main.route('/admin/sql')
+@login_required
+@admin_required
+def sql_stats():
+    return render_template('sql_stats.html', endpoints=query_stats.report(),
+                           threshold=query_stats.threshold)
+
+
+@main.route('/metrics')
+def metrics_export():
+    local = current_app.config['METRICS_ALLOW_LOCAL'] and \
+        request.remote_addr in ('127.0.0.1', '::1') and \
+        'X-Forwarded-For' not in request.headers
+    if not local and not current_user.can(Permission.ADMIN):
+        abort(403)
+    return metrics.exposition(), 200, \
+        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
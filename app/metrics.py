@@ -0,0 +1,336 @@
+import atexit
+import bisect
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+
+# Operational metrics in the Prometheus text format, served at /metrics.
+# Each process keeps its own counters and histograms and writes them to
+# METRICS_DIR/<pid>-<start time>.json every METRICS_FLUSH_INTERVAL seconds,
+# the start time so a reused pid gets a file of its own. A scrape, answered
+# by any one worker, adds up the files of every process. Counters of
+# processes that exited are kept so totals never go down: a starting
+# process folds the files of dead ones into aggregate.json, under a lock
+# that scrapes share. Gauges only come from live processes. Empty
+# METRICS_DIR when deploying.
+
+# Upper bounds in seconds, as in the Prometheus client libraries
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           float('inf'))
+
+HELP = {
+    'microblog_request_duration_seconds': 'Time to handle a request.',
+    'microblog_responses_total': 'Responses sent by status code.',
+    'microblog_db_checkouts_total': 'Connections checked out of the pool.',
+    'microblog_db_checked_out': 'Connections in use.',
+    'microblog_db_overflow': 'Connections open beyond the pool size.',
+    'microblog_db_checkout_wait_seconds': 'Time waited for a connection.',
+    'microblog_db_connects_total': 'Database connections opened.',
+    'microblog_db_closes_total': 'Database connections closed.',
+    'microblog_db_invalidations_total': 'Connections found broken.',
+    'microblog_markdown_render_seconds': 'Time to render a Markdown body.',
+    'microblog_mail_queue_depth': 'Messages waiting to be sent.',
+    'microblog_mail_send_seconds': 'Time to send one message.',
+    'microblog_mail_failed_total': 'Messages given up on.',
+    'microblog_password_check_seconds': 'Time to verify a password hash.',
+    'microblog_accounts_purged_total': 'Deleted accounts fully removed.',
+    'microblog_follow_graph_load_seconds': 'Time to load the follow graph.',
+}
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+class Metrics(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        # (name, labels) -> [count per bucket..., sum]
+        self._histograms = {}
+        self._writer_pid = None
+        self._started = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.path = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        os.makedirs(self.path, exist_ok=True)
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        # After_request is skipped when a view raises and no error handler
+        # answers, count those as 500s.
+        app.teardown_request(self._teardown)
+        atexit.register(self.flush)
+
+    def inc(self, name, value=1, **labels):
+        with self._lock:
+            self._counters[name, _labels(labels)] += value
+
+    def observe(self, name, value, **labels):
+        key = name, _labels(labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(BUCKETS) + [0]
+            histogram[bisect.bisect_left(BUCKETS, value)] += 1
+            histogram[-1] += value
+
+    def timer(self, name, **labels):
+        """ Context manager observing how long its block took """
+        return _Timer(self, name, labels)
+
+    def _start(self):
+        self._start_writer()
+        g.metrics_start = time.time()
+
+    def _finish(self, response):
+        self._record(response.status_code)
+        return response
+
+    def _teardown(self, exc):
+        self._record(500)
+
+    def _record(self, status):
+        # Once per request, whichever of the two gets here first
+        start = g.pop('metrics_start', None)
+        if start is not None:
+            endpoint = request.endpoint or 'unmatched'
+            self.observe('microblog_request_duration_seconds',
+                         time.time() - start, endpoint=endpoint)
+            self.inc('microblog_responses_total', endpoint=endpoint,
+                     status=str(status))
+
+    def _gauges(self):
+        from . import db, mail_dispatcher
+        gauges = {}
+        pool = db.engine.pool
+        # SQLite pools have no overflow.
+        if hasattr(pool, 'overflow'):
+            gauges['microblog_db_checked_out', ()] = pool.checkedout()
+            gauges['microblog_db_overflow', ()] = max(pool.overflow(), 0)
+        gauges['microblog_mail_queue_depth', ()] = \
+            mail_dispatcher.stats()['depth']
+        return gauges
+
+    def _start_writer(self):
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+            self._started = int(time.time() * 1000)
+            # Counts inherited from the parent belong to its own file.
+            self._counters.clear()
+            self._histograms.clear()
+        try:
+            self._fold_dead()
+        except Exception:
+            self.app.logger.exception('Failed to fold dead process metrics.')
+        thread = threading.Thread(target=self._run, name='metrics')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Failed to write metrics.')
+
+    def flush(self):
+        """ Write the metrics of this process to its file """
+        if self._writer_pid != os.getpid():
+            return
+        with self.app.app_context():
+            gauges = self._gauges()
+        with self._lock:
+            data = dict(
+                counters=[[name, labels, value] for (name, labels), value
+                          in self._counters.items()],
+                histograms=[[name, labels, values] for (name, labels), values
+                            in self._histograms.items()],
+                gauges=[[name, labels, value] for (name, labels), value
+                        in gauges.items()])
+        _write(os.path.join(self.path, '%d-%d.json' % (
+            os.getpid(), self._started)), data)
+
+    def _fold_dead(self):
+        """ Add the counters of exited processes to aggregate.json """
+        aggregate = os.path.join(self.path, 'aggregate.json')
+        with self._locked(fcntl.LOCK_EX):
+            dead = [name for name in self._process_files()
+                    if not self._is_alive(name)]
+            if not dead:
+                return
+            counters, histograms, gauges = _add_files(
+                [aggregate] + dead, lambda name: False)
+            _write(aggregate, dict(
+                counters=[[name, labels, value] for (name, labels), value
+                          in counters.items()],
+                histograms=[[name, labels, values] for (name, labels), values
+                            in histograms.items()],
+                gauges=[]))
+            for name in dead:
+                os.remove(name)
+
+    def _is_alive(self, name):
+        pid, _, started = os.path.basename(name)[:-len('.json')].\
+            partition('-')
+        # An earlier process that had the same pid
+        if pid == str(os.getpid()):
+            return started == str(self._started)
+        return _alive(pid)
+
+    def _process_files(self):
+        return [name for name in glob.glob(os.path.join(self.path, '*.json'))
+                if os.path.basename(name) != 'aggregate.json']
+
+    def _locked(self, operation):
+        return _FileLock(os.path.join(self.path, '.lock'), operation)
+
+    def collect(self):
+        """ Sum the files of every process, this one up to date """
+        self._start_writer()
+        self.flush()
+        # Not while dead processes are folded, they would count twice.
+        with self._locked(fcntl.LOCK_SH):
+            return _add_files(
+                [os.path.join(self.path, 'aggregate.json')] +
+                self._process_files(), self._is_alive)
+
+    def exposition(self):
+        """ All metrics in the Prometheus text format """
+        counters, histograms, gauges = self.collect()
+        lines = []
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            for name in sorted({name for name, labels in metrics}):
+                lines += _header(name, kind)
+                for (metric, labels), value in sorted(metrics.items()):
+                    if metric == name:
+                        lines.append('%s%s %s' % (name, _format(labels),
+                                                  _number(value)))
+        for name in sorted({name for name, labels in histograms}):
+            lines += _header(name, 'histogram')
+            for (metric, labels), values in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                count = 0
+                for bound, value in zip(BUCKETS, values):
+                    count += value
+                    lines.append('%s_bucket%s %d' % (
+                        name, _format(labels + (('le', _number(bound)),)),
+                        count))
+                lines.append('%s_sum%s %s' % (name, _format(labels),
+                                              _number(values[-1])))
+                lines.append('%s_count%s %d' % (name, _format(labels),
+                                                count))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.time() - self.start,
+                             **self.labels)
+
+
+class _FileLock(object):
+    def __init__(self, path, operation):
+        self.path = path
+        self.operation = operation
+
+    def __enter__(self):
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, self.operation)
+
+    def __exit__(self, *exc):
+        # Closing the file releases the lock
+        self.file.close()
+
+
+def _write(name, data):
+    with open(name + '.tmp', 'w') as f:
+        json.dump(data, f)
+    os.replace(name + '.tmp', name)
+
+
+def _add_files(names, live):
+    """ Sum the metrics in names, gauges only of the ones live() accepts """
+    counters = defaultdict(float)
+    histograms = {}
+    gauges = defaultdict(float)
+    for name in names:
+        try:
+            with open(name) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, value in data['counters']:
+            counters[metric, _pairs(labels)] += value
+        for metric, labels, values in data['histograms']:
+            key = metric, _pairs(labels)
+            total = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                total[i] += value
+        if live(name):
+            for metric, labels, value in data['gauges']:
+                gauges[metric, _pairs(labels)] += value
+    return counters, histograms, gauges
+
+
+def _pairs(labels):
+    return tuple(tuple(pair) for pair in labels)
+
+
+def _alive(pid):
+    try:
+        os.kill(int(pid), 0)
+    except (ValueError, ProcessLookupError):
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _header(name, kind):
+    return ['# HELP %s %s' % (name, HELP.get(name, '')),
+            '# TYPE %s %s' % (name, kind)]
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (key, value.replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+@event.listens_for(Pool, 'checkout')
+def _checkout(dbapi_connection, connection_record, connection_proxy):
+    from . import metrics
+    metrics.inc('microblog_db_checkouts_total')
@@ -3,9 +3,10 @@ from flask_bcrypt import generate_password_hash, check_password_hash
 from flask_login import UserMixin, AnonymousUserMixin
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from flask import current_app
-from markdown import markdown
-from bleach import linkify, clean
-from . import db, login_manager
+from sqlalchemy.orm import Session, joinedload, object_session
+from . import db, login_manager, last_seen, user_cache, role_registry, \
+    markdown_renderer, search_index, response_cache, metrics, account_purger, \
+    follow_graph, fragment_cache
 
 from os import urandom
 from base64 import b64encode
@@ -50,10 +51,10 @@ class Role(db.Model):
                               Permission.MODERATE, Permission.ADMIN]
         }
         # User, Moderator, Administrator
-        # I don't know why but it must the Administrator can't add so I try 2 time
+        existing = {role.name: role for role in Role.query.all()}
         for r in roles:
             # Check if there is role that needed to be create
-            role = Role.query.filter_by(name=r).first()
+            role = existing.get(r)
             if role is None:
                 # Create a role
                 role = Role(name=r)
@@ -63,6 +64,7 @@ class Role(db.Model):
                 role.add_permissions(perm)
             db.session.add(role)
         db.session.commit()
+        role_registry.load()
 
     def add_permissions(self, perm):
         if not self.has_permisssions(perm):
@@ -73,7 +75,7 @@ class Role(db.Model):
             self.permissions -= perm
 
     def has_permisssions(self, perm):
-        return self.permissions > perm
+        return self.permissions & perm == perm
 
     def reset_permissions(self):
         self.permissions = 0
@@ -89,6 +91,11 @@ class Follow(db.Model):
     followed_id = db.Column(db.Integer, db.ForeignKey('users.id'),
                             primary_key=True)
     time = db.Column(db.DateTime, default=datetime.utcnow)
+    # Following and follower lists, newest first
+    __table_args__ = (
+        db.Index('ix_follow_follower_id_time', 'follower_id', 'time'),
+        db.Index('ix_follow_followed_id_time', 'followed_id', 'time'),
+    )
 
 
 class User(UserMixin, db.Model):
@@ -105,11 +112,22 @@ class User(UserMixin, db.Model):
     location = db.Column(db.String(64))
     register_time = db.Column(db.DateTime, default=datetime.utcnow)
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # Authors with too many followers are merged into timelines at read time
+    # instead of being fanned out on write, see app/timeline.py
+    popular = db.Column(db.Boolean, default=False)
+    # Kept up to date by the listeners below User, so that profile pages
+    # do not count rows. Run the reconcile_counters command to repair drift.
+    follower_count = db.Column(db.Integer, default=0, server_default='0')
+    following_count = db.Column(db.Integer, default=0, server_default='0')
+    post_count = db.Column(db.Integer, default=0, server_default='0')
+    # Set by delete_user, the rows are then removed by app/purge.py
+    deleted_at = db.Column(db.DateTime)
 
     # Foreign Key
     role_id = db.Column(db.Integer, db.ForeignKey('roles.id'))
 
-    # If we delete the user, delete all the posts
+    # If we delete the user, delete all the posts. Accounts deleted from the
+    # site are purged in batches instead, see delete_user.
     # http://docs.sqlalchemy.org/en/latest/orm/cascades.html
     posts = db.relationship('Post', backref='author', lazy='dynamic',
                             cascade='all, delete-orphan')
@@ -133,13 +151,13 @@ class User(UserMixin, db.Model):
 
     def __init__(self, **kwargs):
         super(User, self).__init__(**kwargs)
-        if self.role is None:
+        if self.role is None and self.role_id is None:
             if self.email == current_app.config['MAIL_USERNAME']:
                 # If the user is the admin, make it admin.
-                self.role = Role.query.filter_by(name='Administrator').first()
+                self.role_id = role_registry.id_for('Administrator')
             else:
                 # Or make it regular user
-                self.role = Role.query.filter_by(name='User').first()
+                self.role_id = role_registry.id_for('User')
 
         self.twofa = b64encode(urandom(16)).decode('utf-8')
         # commit changes to database.
@@ -155,7 +173,9 @@ class User(UserMixin, db.Model):
         self.password_hash = generate_password_hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        # bcrypt is slow on purpose, keep an eye on how slow
+        with metrics.timer('microblog_password_check_seconds'):
+            return check_password_hash(self.password_hash, password)
 
     def generate_email_token(self):
         s = Serializer(current_app.config['SECRET_KEY'], expires_in=3600)
@@ -171,6 +191,7 @@ class User(UserMixin, db.Model):
             self.confirmed = True
             db.session.add(self)
             db.session.commit()
+            user_cache.invalidate(self.id)
             return True
         else:
             return False
@@ -192,6 +213,7 @@ class User(UserMixin, db.Model):
         user.password = new_password
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
         return True
 
     def generate_email_changing_token(self, new_email):
@@ -213,47 +235,46 @@ class User(UserMixin, db.Model):
         user.email = load['new_email']
         db.session.add(user)
         db.session.commit()
+        user_cache.invalidate(user.id)
         return True
 
     def can(self, perm):
-        return self.role.has_permisssions(perm)
+        # Plain integer check against the cached roles, see app/registry.py
+        return role_registry.can(self.role_id, perm)
 
     def is_admin(self):
         return self.can(Permission.ADMIN)
 
     def ping(self):
-        self.last_seen = datetime.utcnow()
-        db.session.add(self)
-        db.session.commit()
+        # Written in batches by app/last_seen.py instead of one commit each
+        last_seen.touch(self.id)
 
     def follow(self, to_follow):
+        from .loaders import forget_relationships
         if not self.is_following(to_follow):
             follow = Follow(follower=self, followed=to_follow)
             db.session.add(follow)
             db.session.commit()
+            forget_relationships()
 
     def unfollow(self, to_unfollow):
+        from .loaders import forget_relationships
         if self.is_following(to_unfollow):
             unfollow = Follow.query.filter_by(
                 follower_id=self.id, followed_id=to_unfollow.id).first()
             db.session.delete(unfollow)
             db.session.commit()
+            forget_relationships()
 
+    # Both are answered by loaders.load_relationships and cached for the
+    # request, so asking twice, or for a whole page of users, is one query.
     def is_following(self, user):
-        follow = Follow.query.filter_by(follower_id=self.id,
-                                        followed_id=user.id).first()
-        if follow is None:
-            return False
-        else:
-            return True
+        from .loaders import load_relationships
+        return load_relationships(self, [user.id])[user.id].following
 
     def is_followed_by(self, user):
-        follow = Follow.query.filter_by(follower_id=user.id,
-                                        followed_id=self.id).first()
-        if follow is None:
-            return False
-        else:
-            return True
+        from .loaders import load_relationships
+        return load_relationships(self, [user.id])[user.id].followed_by
 
     def create_twofa(self):
         return OtpAuth(self.twofa).to_uri(type='totp', label=self.id,
@@ -267,15 +288,108 @@ class User(UserMixin, db.Model):
         self.twofa_enable = False
         db.session.add(self)
         db.session.commit()
+        user_cache.invalidate(self.id)
 
     def delete_user(self):
-        db.session.delete(self)
+        # Hidden at once. Deleting the rows through the cascades above would
+        # load every one of them, so that is done in the background.
+        self.deleted_at = datetime.utcnow()
+        db.session.add(self)
         db.session.commit()
+        user_cache.invalidate(self.id)
+        account_purger.submit(self.id)
+
+    @staticmethod
+    def reconcile_counters(chunk_size=1000):
+        """ Recount followers, following and posts of every user """
+        users = User.__table__
+        follow = Follow.__table__
+        posts = Post.__table__
+        followers = db.select([db.func.count()]).where(db.and_(
+            follow.c.followed_id == users.c.id,
+            follow.c.follower_id != follow.c.followed_id)).as_scalar()
+        following = db.select([db.func.count()]).where(db.and_(
+            follow.c.follower_id == users.c.id,
+            follow.c.follower_id != follow.c.followed_id)).as_scalar()
+        post_count = db.select([db.func.count()]).where(
+            posts.c.author_id == users.c.id).as_scalar()
+
+        last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+        for start in range(0, last_id + 1, chunk_size):
+            db.session.execute(users.update().where(db.and_(
+                users.c.id >= start, users.c.id < start + chunk_size)).values(
+                follower_count=followers, following_count=following,
+                post_count=post_count))
+            db.session.commit()
+        user_cache.clear()
+        response_cache.clear()
 
     def __repr__(self):
         return self.nickname or self.username
 
 
+def _add_to_counters(connection, target, user_id, **deltas):
+    users = User.__table__
+    connection.execute(users.update().where(users.c.id == user_id).values(
+        {users.c[name]: users.c[name] + delta
+         for name, delta in deltas.items()}))
+    # Cached copies from the user loader would show the old numbers. Not
+    # before the commit, a request in between would cache them again.
+    object_session(target).info.setdefault('user_cache', set()).add(
+        user_id)
+
+
+# http://docs.sqlalchemy.org/en/latest/orm/events.html#session-events
+@db.event.listens_for(Session, 'after_commit')
+def _forget_users(session):
+    for user_id in session.info.pop('user_cache', ()):
+        user_cache.invalidate(user_id)
+
+
+@db.event.listens_for(Session, 'after_rollback')
+def _keep_users(session):
+    session.info.pop('user_cache', None)
+
+
+# Counters are updated with the same connection, so they commit or roll
+# back together with the row that changed them.
+@db.event.listens_for(Follow, 'after_insert')
+def follow_counted(mapper, connection, target):
+    if target.follower_id != target.followed_id:
+        _add_to_counters(connection, target, target.follower_id,
+                         following_count=1)
+        _add_to_counters(connection, target, target.followed_id,
+                         follower_count=1)
+
+
+@db.event.listens_for(Follow, 'after_delete')
+def unfollow_counted(mapper, connection, target):
+    if target.follower_id != target.followed_id:
+        _add_to_counters(connection, target, target.follower_id,
+                         following_count=-1)
+        _add_to_counters(connection, target, target.followed_id,
+                         follower_count=-1)
+
+
+def _user_tags(user):
+    tags = ('user:%s' % user.id,)
+    # Names show next to every post, so renaming affects them all, and
+    # deleting the account hides them. Rows written with Core, like the
+    # counters and last_seen, leave them alone.
+    if isinstance(user, User) and any(
+            db.inspect(user).attrs[name].history.has_changes()
+            for name in ('username', 'nickname', 'deleted_at')):
+        tags += ('posts',)
+    return tags
+
+
+# The counters above are covered by the tags of the row that changed them.
+response_cache.track(User, _user_tags)
+response_cache.track(Follow, lambda follow: (
+    'user:%s' % follow.follower_id, 'user:%s' % follow.followed_id))
+follow_graph.track(Follow)
+
+
 class AnomymousUser(AnonymousUserMixin):
     @staticmethod
     def can(permission):
@@ -292,7 +406,23 @@ login_manager.anonymous_user = AnomymousUser
 # https://flask-login.readthedocs.io/en/latest/#how-it-works
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    user = user_cache.get(user_id)
+    if user is None:
+        # Load the user and role in a session of their own, so the cached
+        # instances stay detached and never expire with a request commit.
+        session = db.create_session({})()
+        try:
+            user = session.query(User).options(joinedload(User.role)).\
+                get(user_id)
+        finally:
+            session.close()
+        if user is None or user.deleted_at is not None:
+            return None
+        user_cache.set(user_id, user)
+    # Attach a copy to this request's session without querying.
+    # http://docs.sqlalchemy.org/en/latest/orm/session_state_management.html#merging
+    return db.session.merge(user, load=False)
 
 
 class Post(db.Model):
@@ -302,19 +432,123 @@ class Post(db.Model):
     body = db.Column(db.Text)
     # User's input is markdown, convert them to HTML
     body_html = db.Column(db.Text)
-    time = db.Column(db.DateTime, default=datetime.utcnow)
+    time = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     repost = db.Column(db.Boolean, default=False)
+    # Kept up to date by the Comment listeners. Rows from before the column
+    # existed are NULL until backfilled, see loaders.load_comment_counts.
+    # Rows inserted with Core start at 0, run backfill_comment_counts
+    # --recount after inserting comments that way.
+    comment_count = db.Column(db.Integer, default=0)
     comments = db.relationship('Comment', backref='post', lazy='dynamic')
+    # Profile pages and the popular authors merged into timelines
+    __table_args__ = (
+        db.Index('ix_posts_author_id_time', 'author_id', 'time'),
+    )
 
     def delete_post(self):
         db.session.delete(self)
         db.session.commit()
 
+    @staticmethod
+    def by_live_authors(query):
+        """ Leave out posts of deleted accounts, until they are purged """
+        return query.join(User, User.id == Post.author_id).filter(
+            User.deleted_at == None)
+
+    @staticmethod
+    def count_comments(post_ids):
+        """ {post id: number of comments} with one GROUP BY """
+        counts = db.session.query(Comment.post_id, db.func.count()).\
+            filter(Comment.post_id.in_(post_ids)).\
+            group_by(Comment.post_id)
+        return dict(counts)
+
+    @staticmethod
+    def backfill_comment_counts(chunk_size=1000, recount=False):
+        """ Set comment_count of the posts that do not have one yet
+
+        With recount, every post is counted again, chunk by chunk of ids.
+        """
+        posts = Post.__table__
+        if recount:
+            comments = Comment.__table__
+            count = db.select([db.func.count()]).where(
+                comments.c.post_id == posts.c.id).as_scalar()
+            last_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+            for start in range(0, last_id + 1, chunk_size):
+                db.session.execute(posts.update().where(db.and_(
+                    posts.c.id >= start, posts.c.id < start + chunk_size)).
+                    values(comment_count=count))
+                db.session.commit()
+            response_cache.clear()
+            return
+        while True:
+            ids = [row[0] for row in db.session.query(Post.id).filter(
+                Post.comment_count == None).limit(chunk_size)]
+            if not ids:
+                break
+            counts = Post.count_comments(ids)
+            db.session.execute(
+                posts.update().where(posts.c.id == db.bindparam('_id')).
+                values(comment_count=db.bindparam('_count')),
+                [{'_id': id, '_count': counts.get(id, 0)} for id in ids])
+            db.session.commit()
+        response_cache.clear()
+
 
 # http://docs.sqlalchemy.org/en/latest/orm/events.html#sqlalchemy.orm.events.AttributeEvents.set
 @db.event.listens_for(Post.body, 'set')
 def convert_md_to_html(target, value, oldvalue, initiator):
-    target.body_html = linkify(clean(markdown(value), strip=True))
+    # Cached, or deferred to a worker pool, see app/render.py
+    target.body_html = markdown_renderer.render_for(target, value)
+
+
+markdown_renderer.track(Post)
+search_index.track(Post)
+response_cache.track(Post, lambda post: (
+    'posts', 'post:%s' % post.id, 'user:%s' % post.author_id))
+
+
+@db.event.listens_for(Post, 'after_insert')
+def post_counted(mapper, connection, target):
+    _add_to_counters(connection, target, target.author_id, post_count=1)
+
+
+@db.event.listens_for(Post, 'after_delete')
+def post_delete_counted(mapper, connection, target):
+    _add_to_counters(connection, target, target.author_id, post_count=-1)
+
+
+@db.event.listens_for(Post, 'after_delete')
+def post_fragment_dropped(mapper, connection, target):
+    fragment_cache.invalidate(target.id)
+
+
+# Materialized home timeline, one row per (reader, post).
+# Rows are written by the listeners in app/timeline.py.
+class Timeline(db.Model):
+    __tablename__ = 'timeline'
+    user_id = db.Column(db.Integer, primary_key=True)
+    post_id = db.Column(db.Integer, primary_key=True, index=True)
+    author_id = db.Column(db.Integer)
+    time = db.Column(db.DateTime)
+    __table_args__ = (
+        db.Index('ix_timeline_user_id_time', 'user_id', 'time'),
+    )
+
+
+# Recent posts ranked by comments and age for /explore?mode=hot.
+# Rows are written by app/hot.py.
+class HotPost(db.Model):
+    __tablename__ = 'hot_posts'
+    post_id = db.Column(db.Integer, primary_key=True)
+    # Double precision, pages are keyed on the exact score
+    score = db.Column(db.Float(53))
+    comments = db.Column(db.Integer)
+    time = db.Column(db.DateTime, index=True)
+    __table_args__ = (
+        db.Index('ix_hot_posts_score', 'score', 'post_id'),
+    )
 
 
 class Comment(db.Model):
@@ -325,12 +559,37 @@ class Comment(db.Model):
     body_html = db.Column(db.Text)
     post_id = db.Column(db.Integer, db.ForeignKey('posts.id'))
     time = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_comments_post_id_time', 'post_id', 'time'),
+    )
 
     def delete_comment(self):
         db.session.delete(self)
         db.session.commit()
 
 
+def _add_to_comment_count(connection, post_id, delta):
+    posts = Post.__table__
+    connection.execute(posts.update().where(posts.c.id == post_id).values(
+        comment_count=posts.c.comment_count + delta))
+
+
+@db.event.listens_for(Comment, 'after_insert')
+def comment_counted(mapper, connection, target):
+    _add_to_comment_count(connection, target.post_id, 1)
+
+
+@db.event.listens_for(Comment, 'after_delete')
+def comment_delete_counted(mapper, connection, target):
+    _add_to_comment_count(connection, target.post_id, -1)
+
+
 @db.event.listens_for(Comment.body, 'set')
 def convert_md_to_html(target, value, oldvalue, initiator):
-    target.body_html = linkify(clean(markdown(value), strip=True))
+    target.body_html = markdown_renderer.render_for(target, value)
+
+
+markdown_renderer.track(Comment)
+# Comment counts show on the post and on the profile of the author
+response_cache.track(Comment, lambda comment: (
+    'post:%s' % comment.post_id, 'user:%s' % comment.author_id))
@@ -0,0 +1,87 @@
+from datetime import datetime
+from flask import request
+from sqlalchemy import and_, or_
+
+# Keyset pagination: instead of OFFSET, every page is a range scan that
+# starts right after the (time, id) of the last row shown, so page 1000
+# costs the same as page 1 and no COUNT(*) is needed.
+# https://use-the-index-luke.com/no-offset
+
+TIME_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def encode_cursor(key):
+    time, id = key
+    return '%s.%d' % (time.strftime(TIME_FORMAT), id)
+
+
+def decode_cursor(token):
+    # Raises ValueError on bad input, so request.args.get(type=...) ignores it
+    time, _, id = token.partition('.')
+    return datetime.strptime(time, TIME_FORMAT), int(id)
+
+
+class KeysetPage(object):
+    def __init__(self, items, key, has_next, has_prev, encode=encode_cursor):
+        self.items = items
+        self.has_next = has_next and bool(items)
+        self.has_prev = has_prev and bool(items)
+        # Older rows come after the last item, newer before the first one.
+        self.next_cursor = encode(key(items[-1])) if self.has_next else None
+        self.prev_cursor = encode(key(items[0])) if self.has_prev else None
+
+
+class Keyset(object):
+    """ A page request, newest first, bounded by a before or after cursor
+
+    Keys are (time, id) unless other encode and decode functions are given,
+    e.g. for (score, id).
+    """
+
+    def __init__(self, per_page, before=None, after=None,
+                 encode=encode_cursor):
+        self.per_page = per_page
+        self.before = before
+        self.after = after if before is None else None
+        self.encode = encode
+
+    @staticmethod
+    def from_request(per_page, encode=encode_cursor, decode=decode_cursor):
+        return Keyset(per_page,
+                      before=request.args.get('before', type=decode),
+                      after=request.args.get('after', type=decode),
+                      encode=encode)
+
+    def query(self, query, time, id):
+        """ Restrict query to the range of this page, plus one extra row """
+        if self.after is not None:
+            t, i = self.after
+            query = query.filter(or_(time > t, and_(time == t, id > i))).\
+                order_by(time.asc(), id.asc())
+        else:
+            if self.before is not None:
+                t, i = self.before
+                query = query.filter(or_(time < t, and_(time == t, id < i)))
+            query = query.order_by(time.desc(), id.desc())
+        return query.limit(self.per_page + 1)
+
+    def page(self, items, key):
+        """ Build the page from rows fetched by one or more query() calls """
+        # Rows may come from several ranges, so dedup and sort them again.
+        items = list({key(item): item for item in items}.values())
+        items.sort(key=key, reverse=self.after is None)
+        more = len(items) > self.per_page
+        items = items[:self.per_page]
+        if self.after is not None:
+            items.reverse()
+            return KeysetPage(items, key, has_next=True, has_prev=more,
+                              encode=self.encode)
+        return KeysetPage(items, key, has_next=more,
+                          has_prev=self.before is not None, encode=self.encode)
+
+
+def paginate(query, time, id, per_page):
+    """ Keyset paginate a single query ordered by (time, id) """
+    keyset = Keyset.from_request(per_page)
+    key = lambda item: (getattr(item, time.key), getattr(item, id.key))
+    return keyset.page(keyset.query(query, time, id).all(), key)
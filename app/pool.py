@@ -0,0 +1,65 @@
+import os
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool, QueuePool
+
+# Connection pool tuning and bookkeeping. The pool settings themselves are
+# the SQLALCHEMY_POOL_* options in config.py, applied by
+# RoutingSQLAlchemy.apply_driver_hacks. Connection churn and time spent
+# waiting for a free connection are exported with the other metrics.
+
+
+class TimedQueuePool(QueuePool):
+    """ QueuePool recording how long each checkout waited """
+
+    def _do_get(self):
+        from . import metrics
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        finally:
+            metrics.observe('microblog_db_checkout_wait_seconds',
+                            time.time() - start)
+
+
+def warm_up(db, app):
+    """ Open pool_size connections of every bind before serving requests """
+    with app.app_context():
+        for bind in [None] + list(app.config['SQLALCHEMY_BINDS'] or ()):
+            engine = db.get_engine(app, bind)
+            # Pools without a size, like SQLite's NullPool, keep nothing.
+            size = engine.pool.size() if hasattr(engine.pool, 'size') else 0
+            connections = [engine.connect() for _ in range(size)]
+            for connection in connections:
+                connection.close()
+
+
+# Connections opened before a fork, e.g. by a warm-up in a preloading
+# gunicorn master, must not be shared with the children.
+# http://docs.sqlalchemy.org/en/latest/core/pooling.html#using-connection-pools-with-multiprocessing
+@event.listens_for(Pool, 'connect')
+def _connected(dbapi_connection, connection_record):
+    from . import metrics
+    connection_record.info['pid'] = os.getpid()
+    metrics.inc('microblog_db_connects_total')
+
+
+@event.listens_for(Pool, 'checkout')
+def _checked_out(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection belongs to pid %d, not %d.' %
+            (connection_record.info['pid'], os.getpid()))
+
+
+@event.listens_for(Pool, 'close')
+def _closed(dbapi_connection, connection_record):
+    from . import metrics
+    metrics.inc('microblog_db_closes_total')
+
+
+@event.listens_for(Pool, 'invalidate')
+def _invalidated(dbapi_connection, connection_record, exception):
+    from . import metrics
+    metrics.inc('microblog_db_invalidations_total')
@@ -0,0 +1,109 @@
+import atexit
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from flask import request
+
+# Sampling profiler for live traffic, enabled by PROFILE_RATE > 0. That
+# fraction of requests is sampled: every PROFILE_INTERVAL seconds a thread
+# records the stack of each request thread being profiled. Counts are kept
+# per endpoint and written every PROFILE_FLUSH_INTERVAL seconds to
+# PROFILE_DIR/<endpoint>.<pid>.folded, in the collapsed stack format of
+# flamegraph.pl and speedscope ("frame;frame;frame count" per line).
+# Nothing is hooked into requests when it is disabled.
+
+
+class Profiler(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.rate = 0
+        self._lock = threading.Lock()
+        # thread id -> endpoint of the request it is handling
+        self._active = {}
+        self._stacks = defaultdict(Counter)
+        self._sampler_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.rate = app.config['PROFILE_RATE']
+        if not self.rate:
+            return
+        self.interval = app.config['PROFILE_INTERVAL']
+        self.flush_interval = app.config['PROFILE_FLUSH_INTERVAL']
+        self.path = app.config['PROFILE_DIR']
+        os.makedirs(self.path, exist_ok=True)
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+        atexit.register(self.flush)
+
+    def _start(self):
+        if random.random() >= self.rate:
+            return
+        self._start_sampler()
+        with self._lock:
+            self._active[threading.get_ident()] = \
+                request.endpoint or 'unmatched'
+
+    def _stop(self, exc):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+
+    def _start_sampler(self):
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._sampler_pid == os.getpid():
+                return
+            self._sampler_pid = os.getpid()
+            self._stacks.clear()
+        thread = threading.Thread(target=self._run, name='profiler')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        flushed = time.time()
+        while True:
+            time.sleep(self.interval)
+            self.sample()
+            if time.time() - flushed >= self.flush_interval:
+                flushed = time.time()
+                try:
+                    self.flush()
+                except OSError:
+                    self.app.logger.exception('Failed to write profiles.')
+
+    def sample(self):
+        frames = sys._current_frames()
+        with self._lock:
+            for ident, endpoint in self._active.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    self._stacks[endpoint][_collapse(frame)] += 1
+
+    def flush(self):
+        """ Rewrite the folded stack file of every endpoint """
+        with self._lock:
+            stacks = {endpoint: list(counts.items())
+                      for endpoint, counts in self._stacks.items()}
+        pid = os.getpid()
+        for endpoint, counts in stacks.items():
+            name = os.path.join(self.path, '%s.%d.folded' % (endpoint, pid))
+            with open(name + '.tmp', 'w') as f:
+                for stack, count in counts:
+                    f.write('%s %d\n' % (stack, count))
+            os.replace(name + '.tmp', name)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s (%s:%d)' % (code.co_name, code.co_filename,
+                                     code.co_firstlineno))
+        frame = frame.f_back
+    # Outermost frame first. Only the last space on a line is special.
+    return ';'.join(name.replace(';', ':') for name in reversed(names))
@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+from collections import Counter
+from queue import Queue
+from sqlalchemy import and_, bindparam, select
+
+
+class AccountPurger(object):
+    """ Removes the rows of deleted accounts in the background
+
+    User.delete_user only marks the account as deleted. A thread then
+    deletes its follows, posts, comments and timeline with Core DELETEs of
+    at most ACCOUNT_PURGE_BATCH rows, committing each batch and sleeping
+    ACCOUNT_PURGE_PAUSE seconds in between, and the user row last. Core
+    statements skip the mapper listeners, so the counters, timelines,
+    search index and cached pages they would update are updated here.
+    Accounts left over by a restart are purged by purge_deleted_users.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self._queue = Queue()
+        self._worker_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config['ACCOUNT_PURGE_BATCH']
+        self.pause = app.config['ACCOUNT_PURGE_PAUSE']
+
+    def submit(self, user_id):
+        """ Purge user_id, which must be marked as deleted and committed """
+        self._start_worker()
+        self._queue.put(user_id)
+
+    def purge_pending(self):
+        """ Purge every account marked as deleted, in this thread """
+        from . import db
+        from .models import User
+        ids = [row[0] for row in db.session.query(User.id).filter(
+            User.deleted_at != None).order_by(User.id)]
+        for user_id in ids:
+            self.purge(user_id)
+        return len(ids)
+
+    def purge(self, user_id):
+        from . import db, user_cache, metrics, fragment_cache
+        from .models import User, Follow, Post, Comment, Timeline, HotPost
+        users = User.__table__
+        follow = Follow.__table__
+        posts = Post.__table__
+        comments = Comment.__table__
+        timeline = Timeline.__table__
+        hot = HotPost.__table__
+        if not db.session.query(User.id).filter(
+                User.id == user_id, User.deleted_at != None).count():
+            return
+
+        # Both sides of each follow, and the counters of the other user
+        for column, other, counter in (
+                (follow.c.follower_id, follow.c.followed_id,
+                 'follower_count'),
+                (follow.c.followed_id, follow.c.follower_id,
+                 'following_count')):
+            for rows in self._batches(select([other]).where(
+                    column == user_id)):
+                ids = [row[0] for row in rows]
+                db.session.execute(follow.delete().where(and_(
+                    column == user_id, other.in_(ids))))
+                ids = [id for id in ids if id != user_id]
+                _add(users, counter, [(id, -1) for id in ids])
+                # Applied to the follow graph after commit, see app/graph.py
+                db.session.info.setdefault('follow_graph', []).extend(
+                    (user_id, id, False) if column is follow.c.follower_id
+                    else (id, user_id, False) for id in ids)
+                # After commit, as for the counters of the Follow listeners
+                db.session.info.setdefault('user_cache', set()).update(ids)
+                _expire(*('user:%s' % id for id in ids))
+
+        # Posts with every comment and timeline row on them, which would
+        # otherwise be left pointing at nothing.
+        for rows in self._batches(select([posts.c.id]).where(
+                posts.c.author_id == user_id)):
+            ids = [row[0] for row in rows]
+            for replies in self._batches(select([comments.c.id]).where(
+                    comments.c.post_id.in_(ids))):
+                db.session.execute(comments.delete().where(
+                    comments.c.id.in_([row[0] for row in replies])))
+            for entries in self._batches(select(
+                    [timeline.c.user_id, timeline.c.post_id]).where(
+                    timeline.c.post_id.in_(ids))):
+                db.session.execute(timeline.delete().where(and_(
+                    timeline.c.user_id == bindparam('_user_id'),
+                    timeline.c.post_id == bindparam('_post_id'))),
+                    [{'_user_id': user, '_post_id': post}
+                     for user, post in entries])
+            db.session.execute(hot.delete().where(hot.c.post_id.in_(ids)))
+            db.session.execute(posts.delete().where(posts.c.id.in_(ids)))
+            for id in ids:
+                fragment_cache.invalidate(id)
+            # Applied after commit, like the changes of the search listeners
+            db.session.info.setdefault('search', []).extend(
+                (id, None) for id in ids)
+            _expire('posts', *('post:%s' % id for id in ids))
+
+        # Comments on the posts of other users. Hot scores are recounted by
+        # the next hot.refresh.
+        for rows in self._batches(select(
+                [comments.c.id, comments.c.post_id]).where(
+                comments.c.author_id == user_id)):
+            db.session.execute(comments.delete().where(
+                comments.c.id.in_([row[0] for row in rows])))
+            counts = Counter(row[1] for row in rows if row[1] is not None)
+            _add(posts, 'comment_count',
+                 [(id, -count) for id, count in counts.items()])
+            _expire(*('post:%s' % id for id in counts))
+
+        for rows in self._batches(select([timeline.c.post_id]).where(
+                timeline.c.user_id == user_id)):
+            db.session.execute(timeline.delete().where(and_(
+                timeline.c.user_id == user_id,
+                timeline.c.post_id.in_([row[0] for row in rows]))))
+
+        db.session.execute(users.delete().where(users.c.id == user_id))
+        _expire('posts', 'user:%s' % user_id)
+        db.session.commit()
+        user_cache.invalidate(user_id)
+        metrics.inc('microblog_accounts_purged_total')
+
+    def _batches(self, query):
+        """ Rows of query, batch_size at a time, until it returns none
+
+        The caller deletes the rows it is given, which are committed before
+        the next batch is read.
+        """
+        from . import db
+        while True:
+            rows = db.session.execute(query.limit(self.batch_size)).\
+                fetchall()
+            if not rows:
+                return
+            yield rows
+            db.session.commit()
+            time.sleep(self.pause)
+
+    def _start_worker(self):
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._worker_pid == os.getpid():
+                return
+            self._worker_pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='account-purge')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            user_id = self._queue.get()
+            try:
+                with self.app.app_context():
+                    self.purge(user_id)
+            except Exception:
+                # Picked up again by the purge_deleted_users command
+                self.app.logger.exception('Failed to purge user %s.',
+                                          user_id)
+
+
+def _add(table, column, deltas):
+    """ Add (id, delta) pairs to column, with one executemany UPDATE """
+    from . import db
+    if deltas:
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('_id')).values(
+                {column: table.c[column] + bindparam('_delta')}),
+            [{'_id': id, '_delta': delta} for id, delta in deltas])
+
+
+def _expire(*tags):
+    # Bumped after commit by app/response_cache.py, as for tracked models
+    from . import db
+    db.session.info.setdefault('response_cache', set()).update(tags)
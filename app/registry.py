@@ -0,0 +1,54 @@
+import threading
+
+
+class RoleRegistry(object):
+    """ Process wide copy of the roles table
+
+    Roles almost never change, so they are read once when the first request
+    arrives and again after Role.insert_roles. Permission checks become an
+    integer AND on the user's role_id with no ORM access.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._permissions = {}
+        self._ids = {}
+        self._choices = []
+        self.loaded = False
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.before_first_request(self.load)
+
+    def load(self):
+        from .models import Role
+        roles = Role.query.order_by(Role.name).all()
+        with self._lock:
+            self._permissions = {role.id: role.permissions or 0
+                                 for role in roles}
+            self._ids = {role.name: role.id for role in roles}
+            self._choices = [(role.id, role.name) for role in roles]
+            # Keep trying until Role.insert_roles has been run.
+            self.loaded = bool(roles)
+
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+
+    def permissions(self, role_id):
+        """ Permission bitmask of role_id """
+        self._ensure_loaded()
+        return self._permissions.get(role_id, 0)
+
+    def can(self, role_id, perm):
+        return self.permissions(role_id) & perm == perm
+
+    def id_for(self, name):
+        self._ensure_loaded()
+        return self._ids.get(name)
+
+    def choices(self):
+        """ (id, name) of every role, ordered by name """
+        self._ensure_loaded()
+        return list(self._choices)
@@ -0,0 +1,124 @@
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from markdown import markdown
+from bleach import linkify, clean
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, object_session
+from .cache import LRUCache
+
+# Bump whenever markdown(), clean() or linkify() settings change, so cached
+# HTML rendered by the old pipeline is not reused.
+SANITIZER_VERSION = '1'
+
+
+def render_markdown(text):
+    return linkify(clean(markdown(text), strip=True))
+
+
+class MarkdownRenderer(object):
+    """ Renders post and comment bodies to sanitized HTML
+
+    Results are cached by a hash of the body and SANITIZER_VERSION. With
+    MARKDOWN_ASYNC, bodies that are not cached are rendered by a worker
+    pool after the row is committed; until then body_html is empty and the
+    templates show the escaped body.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.async_mode = False
+        self.cache = LRUCache()
+        self._lock = threading.Lock()
+        # instance -> body still to be rendered once it has an id
+        self._deferred = weakref.WeakKeyDictionary()
+        self._executor = None
+        self._executor_pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.async_mode = app.config['MARKDOWN_ASYNC']
+        self.workers = app.config['MARKDOWN_WORKERS']
+        self.cache.configure(app.config['MARKDOWN_CACHE_SIZE'])
+
+    @staticmethod
+    def key(text):
+        return sha1((SANITIZER_VERSION + '\0' + text).encode('utf-8')).\
+            hexdigest()
+
+    def render(self, text):
+        """ Render text now, going through the cache """
+        key = self.key(text)
+        html = self.cache.get(key)
+        if html is None:
+            from . import metrics
+            with metrics.timer('microblog_markdown_render_seconds'):
+                html = render_markdown(text)
+            self.cache.set(key, html)
+        return html
+
+    def render_for(self, target, text):
+        """ HTML to store on target, or None if rendering was deferred """
+        if text is None:
+            return None
+        if not self.async_mode:
+            return self.render(text)
+        html = self.cache.get(self.key(text))
+        if html is None:
+            self._deferred[target] = text
+        return html
+
+    def track(self, model):
+        """ Queue deferred bodies of model once its rows are written """
+        event.listen(model, 'after_insert', self._row_written)
+        event.listen(model, 'after_update', self._row_written)
+
+    def _row_written(self, mapper, connection, target):
+        text = self._deferred.pop(target, None)
+        if text is not None:
+            session = object_session(target)
+            session.info.setdefault('markdown', []).append(
+                (mapper.local_table, target.id, text))
+
+    def _submit(self, table, id, text):
+        with self._lock:
+            # Pools do not survive a fork, so each process gets its own.
+            if self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(self.workers)
+                self._executor_pid = os.getpid()
+            self._executor.submit(self._render_row, table, id, text)
+
+    def _render_row(self, table, id, text):
+        from . import db, response_cache
+        html = self.render(text)
+        try:
+            with self.app.app_context():
+                # Skip the write if the body was edited in the meantime.
+                result = db.engine.execute(table.update().where(
+                    table.c.id == id).where(table.c.body == text).values(
+                    body_html=html))
+                if result.rowcount:
+                    # Cached pages still show the escaped body.
+                    row = db.engine.execute(select([table]).where(
+                        table.c.id == id)).first()
+                    if row is not None:
+                        response_cache.rows_changed(table, [row])
+        except Exception:
+            self.app.logger.exception('Failed to store rendered Markdown.')
+
+
+# http://docs.sqlalchemy.org/en/latest/orm/events.html#session-events
+@event.listens_for(Session, 'after_commit')
+def _submit_deferred(session):
+    from . import markdown_renderer
+    for job in session.info.pop('markdown', ()):
+        markdown_renderer._submit(*job)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_deferred(session):
+    session.info.pop('markdown', None)
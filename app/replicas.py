@@ -0,0 +1,163 @@
+import os
+import random
+import threading
+import time
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.sql.expression import Select, UpdateBase
+from .pool import TimedQueuePool
+
+# Read/write splitting. Replicas from SQLALCHEMY_REPLICAS become the binds
+# replica0, replica1, ... SELECTs made while handling a GET or HEAD request
+# go to one healthy replica, picked once per request. Everything else goes
+# to the primary: writes, requests of other methods, work outside of
+# requests, views marked with decorators.use_primary, the rest of a request
+# once it has written, and the requests of a visitor for REPLICA_MAX_LAG
+# seconds after they wrote something, so they see their own changes.
+
+
+class ReplicaSet(object):
+    """ Keeps track of which replicas are up and not too far behind """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        self.keys = ['replica%d' % i for i in
+                     range(len(app.config['SQLALCHEMY_REPLICAS']))]
+        self.max_lag = app.config['REPLICA_MAX_LAG']
+        self.interval = app.config['REPLICA_CHECK_INTERVAL']
+        self.healthy = list(self.keys)
+        self.lag = {}
+        self._lock = threading.Lock()
+        self._checker_pid = None
+
+    def choose(self):
+        """ The bind key of a healthy replica, or None for the primary """
+        if not self.keys:
+            return None
+        self._start_checker()
+        healthy = self.healthy
+        return random.choice(healthy) if healthy else None
+
+    def check(self):
+        healthy = []
+        for key in self.keys:
+            try:
+                with self.app.app_context():
+                    lag = self._lag(self.db.get_engine(self.app, key))
+            except Exception:
+                self.app.logger.exception('Replica %s is down.', key)
+                lag = None
+            self.lag[key] = lag
+            if lag is not None and lag <= self.max_lag:
+                healthy.append(key)
+        self.healthy = healthy
+
+    @staticmethod
+    def _lag(engine):
+        """ Seconds behind the primary, None if replication is broken """
+        with engine.connect() as connection:
+            if engine.dialect.name == 'mysql':
+                row = connection.execute('SHOW SLAVE STATUS').first()
+                # Not set up as a replica, e.g. a second local instance
+                return row['Seconds_Behind_Master'] if row else 0
+            if engine.dialect.name == 'postgresql':
+                return connection.scalar(
+                    'SELECT COALESCE(EXTRACT(EPOCH FROM now() - '
+                    'pg_last_xact_replay_timestamp()), 0)')
+            connection.scalar('SELECT 1')
+            return 0
+
+    def _start_checker(self):
+        # Threads do not survive a fork, so start one in each process.
+        with self._lock:
+            if self._checker_pid == os.getpid():
+                return
+            self._checker_pid = os.getpid()
+        thread = threading.Thread(target=self._run, name='replicas')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            self.check()
+            time.sleep(self.interval)
+
+
+def _wrote():
+    if has_request_context():
+        g.db_primary = True
+        g.db_wrote = True
+
+
+def _use_replica():
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return False
+    if g.get('db_primary'):
+        return False
+    return session.get('_db_primary_until', 0) < time.time()
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and isinstance(clause, Select) and \
+                _use_replica():
+            if 'db_replica' not in g:
+                g.db_replica = self.app.extensions['replicas'].choose()
+            if g.db_replica is not None:
+                return self.db.get_engine(self.app, bind=g.db_replica)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+    def execute(self, clause, params=None, mapper=None, bind=None, **kw):
+        # Core INSERT, UPDATE and DELETE, like the counters and timelines
+        if isinstance(clause, UpdateBase):
+            _wrote()
+        return SignallingSession.execute(self, clause, params, mapper, bind,
+                                         **kw)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for i, uri in enumerate(app.config['SQLALCHEMY_REPLICAS']):
+            binds['replica%d' % i] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        SQLAlchemy.init_app(self, app)
+        app.extensions['replicas'] = ReplicaSet(self, app)
+
+        @app.after_request
+        def stick_to_primary(response):
+            if g.get('db_wrote'):
+                session['_db_primary_until'] = \
+                    time.time() + app.config['REPLICA_MAX_LAG']
+            return response
+
+    def apply_pool_defaults(self, app, options):
+        SQLAlchemy.apply_pool_defaults(self, app, options)
+        # Test connections on checkout, idle ones may have been dropped.
+        if app.config['SQLALCHEMY_POOL_PRE_PING']:
+            options['pool_pre_ping'] = True
+
+    def apply_driver_hacks(self, app, info, options):
+        if info.drivername.startswith('sqlite'):
+            # SQLite connections cannot move between threads, so leave the
+            # pool to Flask-SQLAlchemy, which uses none for database files.
+            for key in ('pool_size', 'max_overflow', 'pool_timeout'):
+                options.pop(key, None)
+        else:
+            options['poolclass'] = TimedQueuePool
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+
+    def create_session(self, options):
+        options['db'] = self
+        return orm.sessionmaker(class_=RoutingSession, **options)
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def _flushed(db_session, flush_context):
+    _wrote()
@@ -0,0 +1,311 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import urlencode
+from flask import request, session, g, make_response
+from flask_login import current_user
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from .cache import LRUCache
+
+# Whole page cache for logged out visitors. Every cached page records the
+# generation of the tags it depends on, such as 'posts' for the list of all
+# posts or 'user:<id>' for a profile, and is only served while none of them
+# has changed. Committing a change to a tracked model bumps its tags, see
+# ResponseCache.track, writes made with Core bump them with bump() or
+# rows_changed(). RESPONSE_CACHE_TTL bounds anything that slips through,
+# like last seen times.
+
+# Tag generations are bounded too. Every bump takes the next value of one
+# counter, and only the RESPONSE_CACHE_TAGS most recently bumped tags are
+# kept. A tag that is not kept reads as the highest generation dropped so
+# far. That value is at least its last real generation, so pages from
+# before its last bump never match again, at the cost of some pages that
+# were still fresh.
+
+# Response headers stored with the page, validators included, so a cached
+# page still answers conditional requests with 304.
+HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Cache-Control')
+
+
+class MemoryBackend(object):
+    """ Per process LRU, fine for a single worker """
+
+    def __init__(self, maxsize, ttl, maxtags):
+        self._responses = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+        self.maxtags = maxtags
+        # tag -> generation, least recently bumped first
+        self._generations = OrderedDict()
+        self._counter = 0
+        self._floor = 0
+
+    def get(self, key):
+        return self._responses.get(key)
+
+    def set(self, key, body, headers, tags):
+        self._responses.set(key, (body, headers, tags))
+
+    def generations(self, tags):
+        with self._lock:
+            return {tag: self._generations.get(tag, self._floor)
+                    for tag in tags}
+
+    def bump(self, tags):
+        with self._lock:
+            for tag in tags:
+                self._counter += 1
+                self._generations[tag] = self._counter
+                self._generations.move_to_end(tag)
+            while len(self._generations) > self.maxtags:
+                tag, generation = self._generations.popitem(last=False)
+                self._floor = max(self._floor, generation)
+
+    def clear(self):
+        self._responses.clear()
+
+
+class SQLiteBackend(object):
+    """ Shared by every worker through a SQLite file """
+
+    def __init__(self, path, maxsize, ttl, maxtags):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxtags = maxtags
+        connection = self.connect()
+        try:
+            with connection:
+                connection.executescript('''
+                    CREATE TABLE IF NOT EXISTS responses (
+                        key TEXT PRIMARY KEY, body BLOB, headers TEXT,
+                        tags TEXT, expires REAL, used REAL);
+                    CREATE INDEX IF NOT EXISTS ix_responses_used
+                        ON responses (used);
+                    CREATE TABLE IF NOT EXISTS tags (
+                        tag TEXT PRIMARY KEY, generation INTEGER);
+                    CREATE INDEX IF NOT EXISTS ix_tags_generation
+                        ON tags (generation);
+                    CREATE TABLE IF NOT EXISTS counters (
+                        name TEXT PRIMARY KEY, value INTEGER);
+                    INSERT OR IGNORE INTO counters VALUES ('generation', 0);
+                    INSERT OR IGNORE INTO counters VALUES ('floor', 0);
+                ''')
+        finally:
+            connection.close()
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        now = time.time()
+        connection = self.connect()
+        try:
+            row = connection.execute(
+                'SELECT body, headers, tags, used FROM responses '
+                'WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            if row is None:
+                return None
+            body, headers, tags, used = row
+            # Approximate LRU, a hit is recorded at most once a second so
+            # popular pages do not turn every read into a write.
+            if used < now - 1:
+                with connection:
+                    connection.execute('UPDATE responses SET used = ? '
+                                       'WHERE key = ?', (now, key))
+            return body, json.loads(headers), json.loads(tags)
+        finally:
+            connection.close()
+
+    def set(self, key, body, headers, tags):
+        now = time.time()
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO responses '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, body, json.dumps(headers), json.dumps(tags),
+                     now + self.ttl, now))
+                connection.execute(
+                    'DELETE FROM responses WHERE key IN (SELECT key FROM '
+                    'responses ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                    (self.maxsize,))
+        finally:
+            connection.close()
+
+    def generations(self, tags):
+        tags = list(tags)
+        connection = self.connect()
+        try:
+            # One snapshot, a bump in between would mix two states.
+            with connection:
+                connection.execute('BEGIN')
+                floor = connection.execute(
+                    "SELECT value FROM counters WHERE name = 'floor'").\
+                    fetchone()[0]
+                found = dict(connection.execute(
+                    'SELECT tag, generation FROM tags WHERE tag IN (%s)'
+                    % ','.join('?' * len(tags)), tags)) if tags else {}
+        finally:
+            connection.close()
+        return {tag: found.get(tag, floor) for tag in tags}
+
+    def bump(self, tags):
+        tags = list(tags)
+        connection = self.connect()
+        try:
+            with connection:
+                # Take the write lock first, the counter is read-modify-write.
+                connection.execute('BEGIN IMMEDIATE')
+                counter = connection.execute(
+                    "SELECT value FROM counters WHERE name = 'generation'").\
+                    fetchone()[0]
+                connection.executemany(
+                    'INSERT OR REPLACE INTO tags VALUES (?, ?)',
+                    [(tag, counter + i + 1) for i, tag in enumerate(tags)])
+                connection.execute(
+                    "UPDATE counters SET value = ? WHERE name = 'generation'",
+                    (counter + len(tags),))
+                dropped = connection.execute(
+                    'SELECT MAX(generation) FROM (SELECT generation FROM '
+                    'tags ORDER BY generation DESC LIMIT -1 OFFSET ?)',
+                    (self.maxtags,)).fetchone()[0]
+                if dropped is not None:
+                    connection.execute(
+                        'DELETE FROM tags WHERE generation <= ?', (dropped,))
+                    connection.execute(
+                        "UPDATE counters SET value = MAX(value, ?) "
+                        "WHERE name = 'floor'", (dropped,))
+        finally:
+            connection.close()
+
+    def clear(self):
+        connection = self.connect()
+        try:
+            with connection:
+                connection.execute('DELETE FROM responses')
+        finally:
+            connection.close()
+
+
+class ResponseCache(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        # table -> tags of one of its rows, from track()
+        self._tags = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        name = app.config['RESPONSE_CACHE_BACKEND']
+        size = app.config['RESPONSE_CACHE_SIZE']
+        ttl = app.config['RESPONSE_CACHE_TTL']
+        maxtags = app.config['RESPONSE_CACHE_TAGS']
+        if name == 'sqlite':
+            self.backend = SQLiteBackend(app.config['RESPONSE_CACHE_PATH'],
+                                         size, ttl, maxtags)
+        elif name == 'memory':
+            self.backend = MemoryBackend(size, ttl, maxtags)
+        else:
+            self.backend = None
+
+    def cached(self, *tags):
+        """ Cache the view for anonymous visitors, depending on tags
+
+        The view can add tags of its own with tag().
+        """
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                # Pending flashes are shown once, to this visitor only.
+                if self.backend is None or request.method != 'GET' or \
+                        current_user.is_authenticated or \
+                        '_flashes' in session:
+                    return f(*args, **kwargs)
+
+                key = self._key()
+                hit = self.backend.get(key)
+                if hit is not None:
+                    body, headers, depends = hit
+                    if self.backend.generations(depends) == depends:
+                        response = self.app.response_class(
+                            body, headers=headers)
+                        return response.make_conditional(request)
+
+                # Taken before the view runs, so a change committed while it
+                # renders leaves the stored page already out of date.
+                g.response_cache_tags = self.backend.generations(tags)
+                response = make_response(f(*args, **kwargs))
+                if response.status_code == 200 and not session.modified:
+                    headers = [(name, value) for name, value
+                               in response.headers if name in HEADERS]
+                    self.backend.set(key, response.get_data(), headers,
+                                     g.response_cache_tags)
+                return response
+            return decorated_function
+        return decorator
+
+    def tag(self, *tags):
+        """ Make the page being cached depend on tags as well """
+        depends = g.get('response_cache_tags')
+        if depends is not None:
+            depends.update(self.backend.generations(tags))
+
+    def bump(self, *tags):
+        """ Expire the pages depending on tags, for changes made outside
+        of a session, which should queue them in session.info instead """
+        if self.backend is not None and tags:
+            self.backend.bump(tags)
+
+    def rows_changed(self, table, rows):
+        """ bump() the tags of rows of a tracked model's table, written
+        with Core """
+        tags = self._tags.get(table)
+        if tags is not None:
+            self.bump(*{tag for row in rows for tag in tags(row)})
+
+    def clear(self):
+        if self.backend is not None:
+            self.backend.clear()
+
+    @staticmethod
+    def _key():
+        args = sorted(request.args.items(multi=True))
+        return '%s?%s' % (request.path, urlencode(args))
+
+    def track(self, model, tags):
+        """ Bump tags(target) when rows of model are committed
+
+        tags is also given result rows of the table, see rows_changed.
+        """
+        self._tags[model.__table__] = tags
+
+        def changed(mapper, connection, target):
+            if self.backend is None:
+                return
+            session = object_session(target)
+            session.info.setdefault('response_cache', set()).\
+                update(tags(target))
+
+        event.listen(model, 'after_insert', changed)
+        event.listen(model, 'after_update', changed)
+        event.listen(model, 'after_delete', changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _bump_tags(session):
+    from . import response_cache
+    tags = session.info.pop('response_cache', None)
+    if tags and response_cache.backend is not None:
+        response_cache.backend.bump(tags)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_tags(session):
+    session.info.pop('response_cache', None)
@@ -0,0 +1,301 @@
+import math
+import re
+import sqlite3
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+# Full text search over Post.body. The index lives in its own SQLite file
+# (SEARCH_INDEX_PATH), shared by every worker whatever the main database
+# is. It uses FTS5 when the sqlite3 module supports it, otherwise a plain
+# inverted index of (term, post, frequency) rows scored with BM25 in Python.
+# Changes are applied after the posts they come from are committed.
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return TOKEN.findall((text or '').lower())
+
+
+def encode_cursor(key):
+    return '%r_%d' % key
+
+
+def decode_cursor(token):
+    # Raises ValueError on bad input, so request.args.get(type=...) ignores it
+    score, _, id = token.rpartition('_')
+    return float(score), int(id)
+
+
+def has_fts5():
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE t USING fts5(body)')
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+class FTS5Backend(object):
+    name = 'fts5'
+
+    def create(self, connection):
+        connection.execute('CREATE VIRTUAL TABLE IF NOT EXISTS posts_fts '
+                           'USING fts5(body)')
+
+    def drop(self, connection):
+        connection.execute('DROP TABLE IF EXISTS posts_fts')
+
+    def add(self, connection, rows):
+        self.remove(connection, [id for id, body in rows])
+        connection.executemany(
+            'INSERT INTO posts_fts (rowid, body) VALUES (?, ?)', rows)
+
+    def remove(self, connection, ids):
+        connection.executemany('DELETE FROM posts_fts WHERE rowid = ?',
+                               [(id,) for id in ids])
+
+    def search(self, connection, terms, limit, after):
+        # Quoted terms are matched literally and must all be present.
+        match = ' '.join('"%s"' % term for term in terms)
+        # bm25() is lower for better matches, negate it to sort descending.
+        sql = 'SELECT id, score FROM (SELECT rowid AS id, ' \
+              '-bm25(posts_fts) AS score FROM posts_fts ' \
+              'WHERE posts_fts MATCH ?)'
+        params = [match]
+        if after is not None:
+            sql += ' WHERE score < ? OR (score = ? AND id < ?)'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY score DESC, id DESC LIMIT ?'
+        return [(score, id) for id, score in
+                connection.execute(sql, params + [limit])]
+
+
+class InvertedIndexBackend(object):
+    name = 'inverted'
+    # BM25 parameters
+    k1 = 1.2
+    b = 0.75
+
+    def create(self, connection):
+        connection.executescript('''
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT, post_id INTEGER, tf INTEGER,
+                PRIMARY KEY (term, post_id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_postings_post_id
+                ON postings (post_id);
+            CREATE TABLE IF NOT EXISTS documents (
+                post_id INTEGER PRIMARY KEY, length INTEGER);
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY, count INTEGER, length INTEGER);
+            INSERT OR IGNORE INTO stats VALUES (1, 0, 0);
+        ''')
+
+    def drop(self, connection):
+        connection.executescript('''
+            DROP TABLE IF EXISTS postings;
+            DROP TABLE IF EXISTS documents;
+            DROP TABLE IF EXISTS stats;
+        ''')
+
+    def add(self, connection, rows):
+        self.remove(connection, [id for id, body in rows])
+        for id, body in rows:
+            terms = tokenize(body)
+            connection.executemany(
+                'INSERT INTO postings VALUES (?, ?, ?)',
+                [(term, id, tf) for term, tf in Counter(terms).items()])
+            connection.execute('INSERT INTO documents VALUES (?, ?)',
+                               (id, len(terms)))
+            connection.execute('UPDATE stats SET count = count + 1, '
+                               'length = length + ? WHERE id = 1',
+                               (len(terms),))
+
+    def remove(self, connection, ids):
+        for id in ids:
+            row = connection.execute('SELECT length FROM documents '
+                                     'WHERE post_id = ?', (id,)).fetchone()
+            if row is None:
+                continue
+            connection.execute('DELETE FROM postings WHERE post_id = ?',
+                               (id,))
+            connection.execute('DELETE FROM documents WHERE post_id = ?',
+                               (id,))
+            connection.execute('UPDATE stats SET count = count - 1, '
+                               'length = length - ? WHERE id = 1', row)
+
+    def search(self, connection, terms, limit, after):
+        count, length = connection.execute(
+            'SELECT count, length FROM stats WHERE id = 1').fetchone()
+        if not count:
+            return []
+        average = length / count
+
+        scores = None
+        for term in set(terms):
+            postings = dict(connection.execute(
+                'SELECT post_id, tf FROM postings WHERE term = ?', (term,)))
+            idf = math.log(1 + (count - len(postings) + 0.5) /
+                           (len(postings) + 0.5))
+            if scores is None:
+                scores = dict.fromkeys(postings, 0.0)
+            # Every term has to match, like FTS5.
+            scores = {id: score for id, score in scores.items()
+                      if id in postings}
+            if not scores:
+                return []
+            lengths = self._lengths(connection, scores)
+            for id in scores:
+                tf = postings[id]
+                norm = 1 - self.b + self.b * lengths[id] / average
+                scores[id] += idf * tf * (self.k1 + 1) / (tf + self.k1 * norm)
+
+        results = sorted(((score, id) for id, score in scores.items()),
+                         reverse=True)
+        if after is not None:
+            results = [key for key in results if key < tuple(after)]
+        return results[:limit]
+
+    @staticmethod
+    def _lengths(connection, ids):
+        ids = list(ids)
+        lengths = {}
+        # Stay below SQLite's limit on bound parameters.
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            lengths.update(connection.execute(
+                'SELECT post_id, length FROM documents WHERE post_id IN '
+                '(%s)' % ','.join('?' * len(chunk)), chunk))
+        return lengths
+
+
+class SearchIndex(object):
+    def __init__(self, app=None):
+        self.app = None
+        self.backend = None
+        self._created = False
+        # post -> body set since it was last written
+        self._changed = weakref.WeakKeyDictionary()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.path = app.config['SEARCH_INDEX_PATH']
+        self.backend = FTS5Backend() if has_fts5() \
+            else InvertedIndexBackend()
+
+    def connect(self):
+        connection = sqlite3.connect(self.path, timeout=30)
+        if not self._created:
+            self.backend.create(connection)
+            self._created = True
+        return connection
+
+    @contextmanager
+    def transaction(self):
+        connection = self.connect()
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def add(self, rows):
+        """ Index (post id, body) rows, replacing older versions """
+        with self.transaction() as connection:
+            self.backend.add(connection, rows)
+
+    def remove(self, ids):
+        with self.transaction() as connection:
+            self.backend.remove(connection, ids)
+
+    def search(self, text, limit, after=None):
+        """ (score, post id) of the best matches, after a (score, id) key """
+        terms = tokenize(text)
+        if not terms:
+            return []
+        connection = self.connect()
+        try:
+            return self.backend.search(connection, terms, limit, after)
+        finally:
+            connection.close()
+
+    def rebuild(self, chunks):
+        """ Recreate the index from an iterable of lists of rows """
+        with self.transaction() as connection:
+            self.backend.drop(connection)
+        self._created = False
+        for rows in chunks:
+            self.add(rows)
+
+    def track(self, model):
+        """ Keep the index in step with model, which needs id and body """
+        event.listen(model.body, 'set', self._body_set)
+        event.listen(model, 'after_insert', self._row_written)
+        event.listen(model, 'after_update', self._row_written)
+        event.listen(model, 'after_delete', self._row_deleted)
+
+    def _body_set(self, target, value, oldvalue, initiator):
+        self._changed[target] = value
+
+    def _row_written(self, mapper, connection, target):
+        if target in self._changed:
+            self._queue(target, (target.id, self._changed.pop(target)))
+
+    def _row_deleted(self, mapper, connection, target):
+        self._queue(target, (target.id, None))
+
+    @staticmethod
+    def _queue(target, change):
+        session = object_session(target)
+        session.info.setdefault('search', []).append(change)
+
+    def _apply(self, changes):
+        try:
+            rows = [(id, body) for id, body in changes if body is not None]
+            if rows:
+                self.add(rows)
+            removed = [id for id, body in changes if body is None]
+            if removed:
+                self.remove(removed)
+        except sqlite3.Error:
+            # Searches miss these posts until the next rebuild.
+            self.app.logger.exception('Failed to update the search index.')
+
+
+def rebuild(chunk_size=1000):
+    """ Reindex every post, reading them in id order chunk by chunk """
+    from . import db, search_index
+    from .models import Post
+
+    def chunks():
+        last = 0
+        while True:
+            rows = db.session.query(Post.id, Post.body).\
+                filter(Post.id > last).order_by(Post.id).\
+                limit(chunk_size).all()
+            if not rows:
+                return
+            last = rows[-1][0]
+            yield [tuple(row) for row in rows]
+
+    search_index.rebuild(chunks())
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_changes(session):
+    from . import search_index
+    changes = session.info.pop('search', None)
+    if changes:
+        search_index._apply(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_changes(session):
+    session.info.pop('search', None)
@@ -0,0 +1,136 @@
+import heapq
+import json
+import threading
+import time
+from collections import Counter
+from flask import g, request, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Counts the statements every request runs and how long they take. The
+# same statement text running many times in one request is most likely a
+# lazy relationship loaded row by row in a loop, an N+1.
+# Every request is logged as one JSON line, in debug mode the numbers are
+# also sent as X-SQL-* response headers, and totals per endpoint are kept
+# for the admin page at /admin/sql (per process).
+
+
+class RequestQueries(object):
+    def __init__(self, slowest):
+        self.count = 0
+        self.time = 0.0
+        self.shapes = Counter()
+        self._slowest = slowest
+        self.slowest = []
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.time += duration
+        self.shapes[statement] += 1
+        entry = (duration, statement)
+        if len(self.slowest) < self._slowest:
+            heapq.heappush(self.slowest, entry)
+        else:
+            heapq.heappushpop(self.slowest, entry)
+
+    def repeated(self, threshold):
+        return [(statement, count) for statement, count
+                in self.shapes.most_common() if count >= threshold]
+
+
+class QueryStats(object):
+    def __init__(self, app=None):
+        self.app = None
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.threshold = app.config['SQL_REPEAT_THRESHOLD']
+        self.slowest = app.config['SQL_SLOWEST']
+        app.before_request(self._start)
+        app.after_request(self._finish)
+
+    def _start(self):
+        g.sql_queries = RequestQueries(self.slowest)
+
+    def _finish(self, response):
+        queries = g.pop('sql_queries', None)
+        if queries is None:
+            return response
+        # One bucket for every unknown URL, or scanners would grow it forever
+        endpoint = request.endpoint or 'unmatched'
+        repeated = queries.repeated(self.threshold)
+        self._aggregate(endpoint, queries, repeated)
+
+        line = dict(endpoint=endpoint, path=request.path,
+                    method=request.method,
+                    status=response.status_code, queries=queries.count,
+                    db_ms=round(queries.time * 1000, 2),
+                    slowest=[dict(ms=round(duration * 1000, 2), sql=sql)
+                             for duration, sql
+                             in sorted(queries.slowest, reverse=True)],
+                    repeated=[dict(count=count, sql=sql)
+                              for sql, count in repeated])
+        if repeated:
+            self.app.logger.warning('sql %s', json.dumps(line))
+        else:
+            self.app.logger.info('sql %s', json.dumps(line))
+
+        if self.app.debug:
+            response.headers['X-SQL-Queries'] = str(queries.count)
+            response.headers['X-SQL-Time'] = '%.2f' % (queries.time * 1000)
+            response.headers['X-SQL-Repeated'] = str(len(repeated))
+        return response
+
+    def _aggregate(self, endpoint, queries, repeated):
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = dict(
+                    requests=0, queries=0, time=0.0, max_queries=0,
+                    repeated=0, slowest=[])
+            stats['requests'] += 1
+            stats['queries'] += queries.count
+            stats['time'] += queries.time
+            stats['max_queries'] = max(stats['max_queries'], queries.count)
+            stats['repeated'] += bool(repeated)
+            for entry in queries.slowest:
+                if len(stats['slowest']) < self.slowest:
+                    heapq.heappush(stats['slowest'], entry)
+                else:
+                    heapq.heappushpop(stats['slowest'], entry)
+
+    def report(self):
+        """ [(endpoint, stats)] with the most queries per request first """
+        with self._lock:
+            rows = [(endpoint, dict(stats, slowest=sorted(
+                stats['slowest'], reverse=True)))
+                for endpoint, stats in self.endpoints.items()]
+        rows.sort(key=lambda row: row[1]['queries'] / row[1]['requests'],
+                  reverse=True)
+        return rows
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+
+# Listen on every engine, the one Flask-SQLAlchemy creates is made lazily.
+# https://docs.sqlalchemy.org/en/latest/faq/performance.html#query-profiling
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_execute(conn, cursor, statement, parameters, context,
+                    executemany):
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_execute(conn, cursor, statement, parameters, context,
+                   executemany):
+    duration = time.time() - conn.info['query_start'].pop()
+    # Statements run outside of a request, e.g. by workers, are not counted.
+    queries = g.get('sql_queries') if has_app_context() else None
+    if queries is not None:
+        queries.add(statement, duration)
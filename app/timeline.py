@@ -0,0 +1,140 @@
+from flask import current_app
+from sqlalchemy import select, literal, and_
+from . import db
+from .models import User, Follow, Post, Timeline
+
+# Fan-out on write: every new post is copied into the timeline of each
+# follower, so reading the home page is a single range on
+# timeline(user_id, time). Authors with more followers than
+# TIMELINE_FANOUT_LIMIT are marked as popular and are no longer fanned out,
+# their posts are merged in when the timeline is read.
+timeline = Timeline.__table__
+follow = Follow.__table__
+posts = Post.__table__
+users = User.__table__
+
+
+def _is_popular(connection, user_id):
+    return bool(connection.scalar(
+        select([users.c.popular]).where(users.c.id == user_id)))
+
+
+# http://docs.sqlalchemy.org/en/latest/orm/events.html#sqlalchemy.orm.events.MapperEvents.after_insert
+@db.event.listens_for(Post, 'after_insert')
+def fan_out_post(mapper, connection, target):
+    entry = dict(post_id=target.id, author_id=target.author_id,
+                 time=target.time)
+    readers = [target.author_id]
+
+    if not _is_popular(connection, target.author_id):
+        limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+        # Fetch one more than the limit so we know when to stop fanning out.
+        followers = [row[0] for row in connection.execute(
+            select([follow.c.follower_id]).where(and_(
+                follow.c.followed_id == target.author_id,
+                follow.c.follower_id != target.author_id)).limit(limit + 1))]
+        if len(followers) > limit:
+            connection.execute(users.update().where(
+                users.c.id == target.author_id).values(popular=True))
+        else:
+            readers += followers
+
+    connection.execute(timeline.insert(),
+                       [dict(entry, user_id=reader) for reader in readers])
+
+
+# Timeline has no foreign keys, so clean it up before the post is gone.
+@db.event.listens_for(Post, 'before_delete')
+def remove_post(mapper, connection, target):
+    connection.execute(timeline.delete().where(
+        timeline.c.post_id == target.id))
+
+
+@db.event.listens_for(Follow, 'after_insert')
+def follow_added(mapper, connection, target):
+    if target.follower_id == target.followed_id or \
+            _is_popular(connection, target.followed_id):
+        return
+    # Copy the most recent posts of the followed user into the timeline.
+    recent = select([literal(target.follower_id), posts.c.id,
+                     posts.c.author_id, posts.c.time]).\
+        where(posts.c.author_id == target.followed_id).\
+        order_by(posts.c.time.desc()).\
+        limit(current_app.config['TIMELINE_BACKFILL'])
+    connection.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'time'], recent))
+
+
+@db.event.listens_for(Follow, 'after_delete')
+def follow_removed(mapper, connection, target):
+    if target.follower_id == target.followed_id:
+        return
+    connection.execute(timeline.delete().where(and_(
+        timeline.c.user_id == target.follower_id,
+        timeline.c.author_id == target.followed_id)))
+
+
+@db.event.listens_for(User, 'before_delete')
+def remove_user(mapper, connection, target):
+    connection.execute(timeline.delete().where(
+        timeline.c.user_id == target.id))
+
+
+def popular_followed(user):
+    """ Ids of popular users followed by user, merged at read time """
+    query = db.session.query(Follow.followed_id).\
+        join(User, User.id == Follow.followed_id).\
+        filter(Follow.follower_id == user.id,
+               Follow.followed_id != user.id,
+               User.popular == True)
+    return [row[0] for row in query]
+
+
+def home_page(user, keyset):
+    """ One keyset page of the home timeline of user """
+    entries = Post.by_live_authors(Post.query).\
+        join(Timeline, Timeline.post_id == Post.id).\
+        filter(Timeline.user_id == user.id)
+    items = keyset.query(entries, Timeline.time, Timeline.post_id).all()
+    popular = popular_followed(user)
+    if popular:
+        merged = Post.by_live_authors(Post.query).filter(
+            Post.author_id.in_(popular))
+        items += keyset.query(merged, Post.time, Post.id).all()
+    return keyset.page(items, key=lambda post: (post.time, post.id))
+
+
+def rebuild(chunk_size=1000):
+    """ Rebuild every timeline from the follow table """
+    limit = current_app.config['TIMELINE_FANOUT_LIMIT']
+    counts = db.session.query(Follow.followed_id).\
+        filter(Follow.follower_id != Follow.followed_id).\
+        group_by(Follow.followed_id).\
+        having(db.func.count(Follow.follower_id) > limit)
+    popular = [row[0] for row in counts]
+    db.session.execute(users.update().values(popular=False))
+    if popular:
+        db.session.execute(users.update().where(
+            users.c.id.in_(popular)).values(popular=True))
+    db.session.execute(timeline.delete())
+    db.session.commit()
+
+    last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    for start in range(0, last_id + 1, chunk_size):
+        end = start + chunk_size
+        own = select([posts.c.author_id.label('user_id'), posts.c.id,
+                      posts.c.author_id, posts.c.time]).\
+            where(and_(posts.c.author_id >= start, posts.c.author_id < end))
+        followed = select([follow.c.follower_id, posts.c.id,
+                           posts.c.author_id, posts.c.time]).\
+            select_from(follow.join(
+                posts, posts.c.author_id == follow.c.followed_id).join(
+                users, users.c.id == follow.c.followed_id)).\
+            where(and_(follow.c.follower_id >= start,
+                       follow.c.follower_id < end,
+                       follow.c.follower_id != follow.c.followed_id,
+                       users.c.popular != True))
+        for source in own, followed:
+            db.session.execute(timeline.insert().from_select(
+                ['user_id', 'post_id', 'author_id', 'time'], source))
+        db.session.commit()
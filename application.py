@@ -1,8 +1,13 @@
+import os
+import sys
+import click
 from flask_migrate import Migrate, upgrade
-from app import create_app, db
+from app import create_app, db, account_purger
 from app.models import User, Follow, Role, Permission, Post, Comment
+from app import timeline, fake, search, hot
+from app.explain import report as explain_report
 
-app = create_app('default')
+app = create_app(os.environ.get('FLASK_CONFIG') or 'default')
 migrate = Migrate(app, db)
 
 
@@ -19,5 +24,69 @@ def deploy():
     User.add_self_follows()
 
 
+@app.cli.command()
+def rebuild_timelines():
+    """ Rebuild the home timelines from the follow table """
+    timeline.rebuild()
+
+
+@app.cli.command()
+def refresh_hot():
+    """ Recount the scores of hot posts and drop the old ones """
+    hot.refresh()
+
+
+@app.cli.command()
+def rebuild_search_index():
+    """ Reindex every post for full text search """
+    search.rebuild()
+
+
+@app.cli.command()
+@click.option('--users', default=1000, help='Number of users.')
+@click.option('--posts', default=100000, help='Number of posts.')
+@click.option('--comments', default=100000, help='Number of comments.')
+@click.option('--follows', default=20, help='Average follows per user.')
+@click.option('--chunk-size', default=5000, help='Rows per INSERT.')
+@click.option('--processes', default=None, type=int,
+              help='Worker processes, 1 disables multiprocessing.')
+@click.option('--render', is_flag=True, help='Render Markdown bodies.')
+def seed(users, posts, comments, follows, chunk_size, processes, render):
+    """ Bulk insert a large fake dataset """
+    fake.bulk(users, posts, comments, follows, chunk_size, processes,
+              render)
+
+
+@app.cli.command()
+def reconcile_counters():
+    """ Recount the follower, following and post counters of users """
+    User.reconcile_counters()
+
+
+@app.cli.command()
+def purge_deleted_users():
+    """ Remove the rows of deleted accounts that are not purged yet """
+    click.echo('Purged %d accounts.' % account_purger.purge_pending())
+
+
+@app.cli.command()
+@click.option('--recount', is_flag=True,
+              help='Count the comments of every post again.')
+def backfill_comment_counts(recount):
+    """ Count the comments of posts that have no comment_count yet """
+    Post.backfill_comment_counts(recount=recount)
+
+
+@app.cli.command()
+def explain():
+    """ Check that the main view queries use their indexes """
+    missing = False
+    for endpoint, index, used, plan in explain_report():
+        click.echo('%-22s %-4s %s' % (endpoint, 'OK' if used else 'MISS', plan))
+        missing = missing or not used
+    if missing:
+        sys.exit(1)
+
+
 if __name__ == "__main__":
     app.run()
@@ -12,10 +12,20 @@ class Config:
 
     MAIL_SERVER = os.environ.get(Mail_Provider + 'MAIL_SERVER')
     MAIL_PORT = int(os.environ.get(Mail_Provider + 'MAIL_PORT')) or 587
-    MAIL_USE_TLS = True
+    MAIL_USE_TLS = os.environ.get(Mail_Provider + 'MAIL_USE_TLS',
+                                  'true').lower() == 'true'
     MAIL_USERNAME = os.environ.get(Mail_Provider + 'MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get(Mail_Provider + 'MAIL_PASSWORD')
     MAIL_SUBJECT_PREFIX = '[MICROBLOG]'
+    # Mail is sent by MAIL_WORKERS threads, MAIL_BATCH_SIZE messages per
+    # SMTP connection. Senders wait up to MAIL_QUEUE_TIMEOUT seconds when
+    # the queue is full.
+    MAIL_WORKERS = 2
+    MAIL_BATCH_SIZE = 20
+    MAIL_QUEUE_SIZE = 1000
+    MAIL_QUEUE_TIMEOUT = 5
+    MAIL_MAX_RETRIES = 3
+    MAIL_RETRY_DELAY = 5
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
@@ -23,6 +33,82 @@ class Config:
     FOLLOW_PER_PAGE = 2
     COMMENTS_PER_PAGE = 20
 
+    # Authors with more followers than this are merged at read time
+    TIMELINE_FANOUT_LIMIT = 1000
+    # Number of posts copied into a timeline on follow
+    TIMELINE_BACKFILL = 200
+
+    # Record last seen at most once per interval, flush every few seconds
+    LAST_SEEN_INTERVAL = 60
+    LAST_SEEN_FLUSH_INTERVAL = 10
+
+    # Users cached by the Flask-Login user loader, TTL in seconds
+    USER_CACHE_SIZE = 1024
+    USER_CACHE_TTL = 300
+
+    # Rendered Markdown cached by body hash. With MARKDOWN_ASYNC, uncached
+    # bodies are rendered by MARKDOWN_WORKERS threads after commit.
+    MARKDOWN_CACHE_SIZE = 4096
+    MARKDOWN_ASYNC = os.environ.get('MARKDOWN_ASYNC') == 'true'
+    MARKDOWN_WORKERS = 2
+
+    # SQLite file holding the full text index of posts, see app/search.py
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or \
+        os.path.join(basedir, 'search.sqlite')
+    SEARCH_PER_PAGE = 20
+
+    # Pages cached for logged out visitors: 'memory' for a single process,
+    # 'sqlite' to share RESPONSE_CACHE_PATH between workers, or 'none'
+    RESPONSE_CACHE_BACKEND = os.environ.get('RESPONSE_CACHE_BACKEND') or \
+        'memory'
+    RESPONSE_CACHE_PATH = os.environ.get('RESPONSE_CACHE_PATH') or \
+        os.path.join(basedir, 'responses.sqlite')
+    RESPONSE_CACHE_SIZE = 512
+    RESPONSE_CACHE_TTL = 60
+    # Tag generations kept, older ones expire every page that used them
+    RESPONSE_CACHE_TAGS = 10000
+
+    # Rendered posts kept for timelines, a few KB each
+    FRAGMENT_CACHE_SIZE = 10000
+
+    # The same statement this many times in one request is reported as a
+    # likely N+1, along with the slowest SQL_SLOWEST statements
+    SQL_REPEAT_THRESHOLD = 5
+    SQL_SLOWEST = 5
+
+    # Fraction of requests to profile, 0 disables it. Stacks are sampled
+    # every PROFILE_INTERVAL seconds, see app/profiler.py
+    PROFILE_RATE = float(os.environ.get('PROFILE_RATE') or 0)
+    PROFILE_INTERVAL = 0.005
+    PROFILE_FLUSH_INTERVAL = 60
+    PROFILE_DIR = os.environ.get('PROFILE_DIR') or \
+        os.path.join(basedir, 'profiles')
+
+    # Every worker writes its metrics to METRICS_DIR, /metrics adds them up.
+    # It answers admins, and requests from this host unless they came
+    # through a proxy (X-Forwarded-For) or METRICS_ALLOW_LOCAL is off.
+    METRICS_DIR = os.environ.get('METRICS_DIR') or \
+        os.path.join(basedir, 'metrics')
+    METRICS_FLUSH_INTERVAL = 5
+    METRICS_ALLOW_LOCAL = True
+
+    # Rows removed per transaction when purging a deleted account, and the
+    # pause between transactions, see app/purge.py
+    ACCOUNT_PURGE_BATCH = 1000
+    ACCOUNT_PURGE_PAUSE = 0.1
+
+    # Follow graph kept by each process for suggestions, reloaded every
+    # FOLLOW_GRAPH_RELOAD seconds for the follows of other processes
+    FOLLOW_GRAPH_RELOAD = 600
+    FOLLOW_GRAPH_MAX_DEGREE = 5000
+    SUGGESTIONS_PER_PAGE = 20
+
+    # Hot posts: ten times the comments are worth HOT_DECAY seconds of age.
+    # Posts older than HOT_WINDOW drop out, see app/hot.py
+    HOT_DECAY = 45000
+    HOT_WINDOW = 3 * 24 * 3600
+    HOT_REFRESH_INTERVAL = 600
+
     @staticmethod
     def init_app(app):
         pass
@@ -31,8 +117,38 @@ class Config:
 class SQLConfig(Config):
     DEBUG = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('SQLALCHEMY_DATABASE_URI')
+    # Comma separated URIs of read replicas, see app/replicas.py. Replicas
+    # are checked every REPLICA_CHECK_INTERVAL seconds and skipped while
+    # down or more than REPLICA_MAX_LAG seconds behind the primary.
+    SQLALCHEMY_REPLICAS = [uri for uri in (
+        os.environ.get('SQLALCHEMY_REPLICAS') or '').split(',') if uri]
+    REPLICA_MAX_LAG = 5
+    REPLICA_CHECK_INTERVAL = 10
+
+    # Connection pool of each worker process, ignored by SQLite. Connections
+    # are recycled before MySQL's wait_timeout (8 hours by default, often
+    # lowered) closes them, and tested on checkout when PRE_PING is set.
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('SQLALCHEMY_POOL_SIZE') or 5)
+    SQLALCHEMY_MAX_OVERFLOW = int(
+        os.environ.get('SQLALCHEMY_MAX_OVERFLOW') or 10)
+    SQLALCHEMY_POOL_TIMEOUT = 10
+    SQLALCHEMY_POOL_RECYCLE = 280
+    SQLALCHEMY_POOL_PRE_PING = True
+    # Open SQLALCHEMY_POOL_SIZE connections in create_app
+    SQLALCHEMY_POOL_WARMUP = False
+
+
+class ProductionConfig(SQLConfig):
+    DEBUG = False
+    # Size the pool for the threads of a worker, e.g. gunicorn --threads 16
+    SQLALCHEMY_POOL_SIZE = int(os.environ.get('SQLALCHEMY_POOL_SIZE') or 16)
+    SQLALCHEMY_MAX_OVERFLOW = int(
+        os.environ.get('SQLALCHEMY_MAX_OVERFLOW') or 4)
+    SQLALCHEMY_POOL_TIMEOUT = 5
+    SQLALCHEMY_POOL_WARMUP = True
 
 
 config = {
+    'production': ProductionConfig,
     'default': SQLConfig
 }